@@ -3,15 +3,30 @@ logger = sf.setup_logging("Comparison.log", debug=False)
 
 import pandas as pd
 import analyzefire as af
-from Database import SQLDatabase
+from Database import SQLDatabase, raw_primary_keys
 import Email_Report as er
 from datetime import timedelta, datetime
 import gui
 # from pandasgui import show
 import preprocess as pp
+import ConcurrentUse as cu
+import naming as n
 import os
 import traceback
 import copy
+import numpy as np
+
+# only analyze and upsert the incidents a comparison found to be new or changed
+incremental = True
+
+# compare against the stored Row_Hash of each raw row, instead of pulling and comparing every column
+use_row_hashes = True
+
+# raw file columns used to slice a file for incremental analysis: [incident, unit assigned, unit cleared]
+incremental_columns = {
+    "ems": ["Incident", "Assigned", "Complete"],
+    "fire": ["Master_Incident_Number", "Unit Time Assigned", "Unit Time Call Cleared"],
+}
 
 def get_time_frame(df, data_source):
     """
@@ -54,15 +69,31 @@ def get_from_database(time_frame, data_source):
         df = pd.DataFrame()  # Return an empty DataFrame if there's an error
     return df
 
-def compare_file(from_file_df, from_db_df, data_source):
+def get_hashes_from_database(time_frame, data_source):
+    """Like get_from_database, but only the compare keys and Row_Hash of each row"""
+    columns = ", ".join(f"[{col}]" for col in raw_primary_keys[data_source] + ["Row_Hash"])
+    fire_query = [
+        f"Select {columns} from RawFire where [Earliest Time Phone Pickup AFD or EMS] > '{time_frame['start']}' and [Earliest Time Phone Pickup AFD or EMS] <= '{time_frame['end']}'",
+        ["Unit Time Assigned"],
+    ]
+    ems_query = [
+        f"Select {columns} from RawEMS where Ph_PU_Date > '{time_frame['start']}' and Ph_PU_Date <= '{time_frame['end']}'",
+        ["Assigned"],
+    ]
+
+    args = ems_query if data_source == "ems" else fire_query
+    logger.debug(f"Query: {args[0]}")
+    try:
+        df = db.retrieve_df(*args)
+    except Exception as e:
+        logger.error(f'Error grabbing data from database: {e}')
+        df = pd.DataFrame()  # Return an empty DataFrame if there's an error
+    return df
+
+def prepare_file_for_compare(from_file_df, data_source):
     """
-    Compare our data from the raw weekly file against the data that already exists in the database.
-    Create 2 separate lists for data to update, and data that needs to be inserted
-    the primary clusters should be:
-        data_source "ems":[Incident]+[unit]+[assigned], where unit and assigned can be null
-            {incident: 112233, unit: Eng201, assigned: null} != {incident: 112233, unit: Safe201, assigned: null}
-            {incident: 112233, unit: Eng201, assigned: 2024/02/01 12:30:20.01} != {incident: 112233, unit: S01, assigned: 2024/02/01 12:39:53.84}
-        data_source "fire": [Incident_Number]+[Unit]+[Unit_Assigned]
+    Conform the raw weekly file, in place, to how rows are stored in the database
+    returns the compare keys and closed time column for the data source
     """
     if data_source == "ems":
         compare_keys = ["Incident", "Unit", "Assigned"]
@@ -77,8 +108,6 @@ def compare_file(from_file_df, from_db_df, data_source):
     renames = {"Alarm_Level": "Alarm Level"}
     from_file_df.rename(columns=renames, errors="ignore", inplace=True)
 
-    # Apply rounding to datetime columns in both dataframes
-    pp.round_datetime_columns(from_db_df)
     pp.round_datetime_columns(from_file_df)
 
     if data_source == "ems":
@@ -86,6 +115,67 @@ def compare_file(from_file_df, from_db_df, data_source):
         from_file_df["Zip"] = from_file_df["Zip"].astype(str).replace("<NA>", None, regex=False)
         from_file_df["Destination_Zip"] = from_file_df["Destination_Zip"].astype(str).replace("<NA>", None, regex=False)
 
+    return compare_keys, closed_time_column
+
+def compare_hashes(from_file_df, db_hashes_df, data_source):
+    """
+    Compare the raw weekly file against the Row_Hash stored with each database row.
+    Returns the same update, insert and changed_columns frames as compare_file, pulling full database rows only for the changed rows.
+    Rows stored before Row_Hash existed have no hash, and so are always updates.
+    """
+    compare_keys, closed_time_column = prepare_file_for_compare(from_file_df, data_source)
+
+    file_keys = db.hash_keys(from_file_df, compare_keys)
+    file_hashes = db.row_hashes(from_file_df, compare_keys)
+    if db_hashes_df.empty:
+        stored = {}
+    else:
+        stored = dict(zip(db.hash_keys(db_hashes_df, compare_keys), db_hashes_df["Row_Hash"]))
+
+    found = file_keys.isin(stored.keys())
+    stored_hashes = file_keys.map(stored)
+    changed = found & (stored_hashes != file_hashes)
+
+    update_df = from_file_df.loc[changed, compare_keys].copy()
+    update_df["Changes"] = "Row_Hash: " + file_hashes[changed] + " != " + stored_hashes[changed].fillna("null")
+    changed_columns_df = pd.DataFrame(columns=["Column", "Rows Changed"])
+
+    if changed.any():
+        # only the changed rows are pulled in full, to say which columns changed
+        changed_rows = from_file_df[changed]
+        db_rows = db.get_raw_rows(data_source, changed_rows[compare_keys[0]])
+        details = compare_rows(changed_rows, db_rows, compare_keys, closed_time_column)
+        # a row stored before Row_Hash existed can differ by hash alone, and keeps the hash as its change
+        changes = details["update"]["Changes"]
+        update_df["Changes"] = changes.reindex(update_df.index).fillna(update_df["Changes"])
+        changed_columns_df = details["changed_columns"]
+
+    insert_columns = compare_keys + [closed_time_column]
+    insert_df = from_file_df.loc[~found, insert_columns].copy()
+
+    return {"update": update_df, "insert": insert_df, "changed_columns": changed_columns_df}
+
+def compare_file(from_file_df, from_db_df, data_source):
+    """
+    Compare our data from the raw weekly file against the data that already exists in the database.
+    Create 2 separate lists for data to update, and data that needs to be inserted
+    the primary clusters should be:
+        data_source "ems":[Incident]+[unit]+[assigned], where unit and assigned can be null
+            {incident: 112233, unit: Eng201, assigned: null} != {incident: 112233, unit: Safe201, assigned: null}
+            {incident: 112233, unit: Eng201, assigned: 2024/02/01 12:30:20.01} != {incident: 112233, unit: S01, assigned: 2024/02/01 12:39:53.84}
+        data_source "fire": [Incident_Number]+[Unit]+[Unit_Assigned]
+    """
+    compare_keys, closed_time_column = prepare_file_for_compare(from_file_df, data_source)
+    return compare_rows(from_file_df, from_db_df, compare_keys, closed_time_column)
+
+def compare_rows(from_file_df, from_db_df, compare_keys, closed_time_column):
+    """
+    The comparison of compare_file, for a file already conformed by prepare_file_for_compare.
+    Returns the update and insert frames, and how many updated rows each column changed in.
+    """
+    # Apply rounding to datetime columns in the database dataframe, as the file has been
+    pp.round_datetime_columns(from_db_df)
+
     compare_df = from_file_df.copy()
 
     compare_df.fillna("null", inplace=True)
@@ -101,29 +191,38 @@ def compare_file(from_file_df, from_db_df, data_source):
         and col not in ["index", "Master Incident Without First Two Digits"]
     ]
 
-    db_records = {
-        tuple(row[k] for k in compare_keys): row for _, row in from_db_df.iterrows()
-    }
-
-    update = []
-    insert = []
-    update_changes = []
-
-    for _, new_row in compare_df.iterrows():
-        new_record_key = tuple(new_row[k] for k in compare_keys)
-        if new_record_key in db_records:
-            existing_record = db_records[new_record_key]
-            changed_cols = {
-                col: f"{new_row[col]} != {existing_record[col]}"
-                for col in non_key_columns
-                if new_row[col] != existing_record[col]
-            }
-            if changed_cols:
-                update.append(new_row.name)
-                change_detail = ", ".join([f"{col}: {new_row[col]} != {existing_record[col]}" for col in changed_cols])
-                update_changes.append(change_detail)
-        else:
-            insert.append(new_row.name)
+    # join each file row to the database row with the same keys (the last one, if the database has duplicates)
+    db_unique = from_db_df.drop_duplicates(subset=compare_keys, keep="last")
+    merged = pd.merge(
+        compare_df[compare_keys].assign(file_row=np.arange(len(compare_df))),
+        db_unique[compare_keys].assign(db_row=np.arange(len(db_unique))),
+        how="left",
+        on=compare_keys,
+        indicator=True,
+    )
+    found = (merged["_merge"] == "both").to_numpy()
+    file_rows = merged["file_row"].to_numpy()[found]
+    db_rows = merged["db_row"].to_numpy()[found].astype(int)
+
+    # compare every non key column of every matched row at once, as python objects so 1 == 1.0 like before
+    file_values = np.empty((len(file_rows), len(non_key_columns)), dtype=object)
+    db_values = np.full((len(file_rows), len(non_key_columns)), "null", dtype=object)
+    for i, col in enumerate(non_key_columns):
+        file_values[:, i] = compare_df[col].to_numpy(dtype=object)[file_rows]
+        if col in db_unique.columns:
+            db_values[:, i] = db_unique[col].to_numpy(dtype=object)[db_rows]
+    changed = file_values != db_values
+    has_changes = changed.any(axis=1)
+
+    update_changes = [
+        ", ".join(
+            f"{non_key_columns[i]}: {file_values[row, i]} != {db_values[row, i]}"
+            for i in np.flatnonzero(changed[row])
+        )
+        for row in np.flatnonzero(has_changes)
+    ]
+    update = compare_df.index[file_rows[has_changes]]
+    insert = compare_df.index[merged["file_row"].to_numpy()[~found]]
 
     update_df = from_file_df.loc[update, compare_keys].copy()
     update_df["Changes"] = update_changes
@@ -131,22 +230,113 @@ def compare_file(from_file_df, from_db_df, data_source):
     insert_columns = compare_keys + [closed_time_column]
     insert_df = from_file_df.loc[insert, insert_columns].copy()
 
-    return {"update": update_df, "insert": insert_df}
+    # how many updated rows each column changed in
+    changed_columns_df = pd.DataFrame(
+        {"Column": non_key_columns, "Rows Changed": changed.sum(axis=0)}
+    )
+    changed_columns_df = changed_columns_df[changed_columns_df["Rows Changed"] > 0]
+
+    return {"update": update_df, "insert": insert_df, "changed_columns": changed_columns_df}
+
+def get_overlapping(df, mask, start_column, end_column):
+    """
+    Return a mask of every row whose assigned to cleared interval overlaps the interval of any masked row.
+    These are the rows that concurrent use of the masked rows is counted from.
+    """
+    starts = pd.to_datetime(df[start_column], errors="coerce")
+    ends = pd.to_datetime(df[end_column], errors="coerce").fillna(starts)
+
+    # merge the masked intervals into sorted, non overlapping spans
+    spans = pd.DataFrame({"start": starts[mask], "end": ends[mask]}).dropna().sort_values("start")
+    if spans.empty:
+        return mask
+    new_span = spans["start"] > spans["end"].cummax().shift()
+    spans = spans.groupby(new_span.cumsum()).agg({"start": "min", "end": "max"})
+
+    span_starts = spans["start"].to_numpy()
+    span_ends = spans["end"].to_numpy()
+    # the last span starting before a row ends is the only one that can overlap it
+    pos = np.searchsorted(span_starts, ends.to_numpy(), side="right") - 1
+    overlaps = (pos >= 0) & (span_ends[np.maximum(pos, 0)] >= starts.to_numpy())
+    return mask | (overlaps & starts.notnull().to_numpy())
+
+
+def get_incremental_slice(df, dfs, data_source):
+    """
+    Expand the inserted and updated rows of a comparison to what needs to be analyzed again.
+
+    Returns
+    --------------------------------
+    Dataframe:
+        rows to analyze: the changed incidents, and every incident overlapping them
+    set:
+        incident numbers to upsert: the same incidents
+    """
+    incident_column, start_column, end_column = incremental_columns[data_source]
+    incidents = df[incident_column]
+
+    changed = df.index.isin(dfs["insert"].index.union(dfs["update"].index))
+    # whole incidents, since status, counts and response force are per incident
+    changed = incidents.isin(incidents[changed]).to_numpy()
+
+    # concurrent use of a changed row can change for any unit busy at the same time.
+    # (the concurrent use written is always taken from the whole file, see get_concurrent_use)
+    upsert = incidents.isin(incidents[get_overlapping(df, changed, start_column, end_column)])
+
+    return df[upsert], set(incidents[upsert].astype(str))
+
+
+def get_concurrent_use(df):
+    """
+    Concurrent use of every unit in a whole raw file, named and keyed as in the analyzed output.
+
+    Concurrent use depends on every unit processed before it in the file (a unit assigned without a time clears every bucket,
+    and units drop out in file order), not only those overlapping it, so an incremental slice can't calculate its own.
+    """
+    ppdf = cu.addConcurrentUse(pp.preprocess(df.copy()), "Unit Time Assigned", "Unit Time Call Cleared")
+    columns = ["Master Incident Number", "Radio_Name", "Unit Time Assigned", "Concurrent Usage"]
+    columns += [f"Time_{x}_Active" for x in range(10)]
+    return n.rename(ppdf[columns])
+
+
+def replace_concurrent_use(analyzed_df, concurrent_use):
+    """Overwrite the concurrent use columns of analyzed rows with those calculated from the whole file"""
+    keys = [n.renames[col] for col in ["Master Incident Number", "Radio_Name", "Unit Time Assigned"]]
+    full = concurrent_use.drop_duplicates(keys).set_index(keys)
+    rows = pd.MultiIndex.from_frame(analyzed_df[keys])
+    for col in full.columns:
+        analyzed_df[col] = full[col].reindex(rows).to_numpy()
+    return analyzed_df
+
 
 def process_comparison(file_path):
     df, data_source = gui.readRaw(file_path)
     time_frame = get_time_frame(df, data_source)
-    database_df = get_from_database(time_frame, data_source)
-    # dfs = [df, database_df]
-    # show(*dfs)  # Uncomment to use pandasgui for visualization if available
+    if use_row_hashes:
+        database_df = get_hashes_from_database(time_frame, data_source)
+        dfs = compare_hashes(df, database_df, data_source)
+    else:
+        database_df = get_from_database(time_frame, data_source)
+        # dfs = [df, database_df]
+        # show(*dfs)  # Uncomment to use pandasgui for visualization if available
 
-    dfs = compare_file(df, database_df, data_source)
+        dfs = compare_file(df, database_df, data_source)
     # for dftype, df_to_apply in dfs.items():
     #     apply_compared_corrections_to_database(df_to_apply, dftype, data_source)
 
-    # Insert the entire weekly file
     try:
-        apply_compared_corrections_to_database(df, 'insert', data_source)
+        if incremental:
+            # Insert only what changed, with enough of the file around it to analyze it correctly
+            slice_df, upsert_incidents = get_incremental_slice(df, dfs, data_source)
+            logger.info(
+                f"Incremental comparison: analyzing {len(slice_df)} of {len(df)} rows, upserting {len(upsert_incidents)} incidents"
+            )
+            apply_compared_corrections_to_database(
+                slice_df, 'insert', data_source, upsert_incidents, get_concurrent_use(df)
+            )
+        else:
+            # Insert the entire weekly file
+            apply_compared_corrections_to_database(df, 'insert', data_source)
         email_compare_results(dfs, time_frame, data_source, success=True)
     except Exception as e:
         logger.error(f'Error during processing: {e}')
@@ -198,12 +388,14 @@ def process_directory(directory, file_types, move_on_success, move_on_failure):
                 logger.error(f"Failed to move file {file_path} to failure directory: {move_error}")
 
 
-def apply_compared_corrections_to_database(df, operation_type, source_type):
+def apply_compared_corrections_to_database(df, operation_type, source_type, upsert_incidents=None, concurrent_use=None):
     """
     Process a DataFrame either for insert or update.
     Args:
         df (pd.DataFrame): The DataFrame to process.
         operation_type (str): Type of operation ('insert' or 'update').
+        upsert_incidents (set, optional): Incident numbers to write to the database.  The rest of df is only context for the analysis.  Writes everything when None.
+        concurrent_use (pd.DataFrame, optional): Concurrent use from get_concurrent_use, for when df is only part of a file.
     """
     print(f"Processing {operation_type} DataFrame")
     
@@ -225,14 +417,21 @@ def apply_compared_corrections_to_database(df, operation_type, source_type):
         logger.error(f"Error applying data corrections: {e}\nTraceback: {tb}")
         exit()
 
+    if upsert_incidents is not None:
+        incident_column = incremental_columns[source_type][0]
+        df = df[df[incident_column].astype(str).isin(upsert_incidents)]
+        analyzed_df = analyzed_df[analyzed_df["Incident_Number"].astype(str).isin(upsert_incidents)]
+    if concurrent_use is not None:
+        analyzed_df = replace_concurrent_use(analyzed_df, concurrent_use)
+
     if operation_type == 'insert':
         logger.info(f'Insert this to database!')
-        db.UpsertRaw(df, source_type)
-        db.new_insert_DF(analyzed_df, source_type)
+        db.UpsertRaw(df, source_type, bulk=True, skip_unchanged=True)
+        db.new_insert_DF(analyzed_df, source_type, bulk=True)
     elif operation_type == 'update':
         logger.info(f'Update into to database!')
-        db.UpsertRaw(df, source_type)
-        db.new_insert_DF(analyzed_df, source_type)
+        db.UpsertRaw(df, source_type, bulk=True, skip_unchanged=True)
+        db.new_insert_DF(analyzed_df, source_type, bulk=True)
 
     logger.info(f"Completed processing {operation_type} DataFrame")
 
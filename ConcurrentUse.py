@@ -9,12 +9,40 @@ from tqdm import tqdm
 ourDepartment = ["ESD02 - Pflugerville", "ESD02"]
 
 
-def recalcDict(arr, time):
-    # print("=========================\n", arr)
-    for bucket in arr:
-        arr[bucket] = list(filter(lambda x: x > time, arr[bucket]))
-    # print("\n------\n", arr, "\n")
-    return arr
+def getDeathPositions(starts, ends):
+    """
+    For each row (in processing order), find the first position at or after it whose start time is not before the rows end time.
+    This is the point at which the row would drop out of the list of active buckets.
+
+    Parameters
+    --------------------------------
+    starts : np.ndarray of int64
+        start times as nanoseconds, in processing order.  Null starts should already be set to the max int64
+    ends : np.ndarray of int64
+        end times as nanoseconds, in processing order.  Null ends should already be set to the min int64
+
+    Returns
+    --------------------------------
+    np.ndarray
+        positions, where len(starts) means the row never drops out
+    """
+    n = len(starts)
+    # sparse table of range maximums: table[k][p] = max(starts[p : p + 2**k])
+    table = [starts]
+    while (1 << len(table)) <= n:
+        prev = table[-1]
+        half = 1 << (len(table) - 1)
+        table.append(np.maximum(prev[:-half], prev[half:]))
+
+    # binary lift every row forward for as long as all starts stay before its end
+    pos = np.arange(n)
+    for k in range(len(table) - 1, -1, -1):
+        step = 1 << k
+        canStep = pos + step <= n
+        lookup = np.where(canStep, pos, 0)
+        canStep[canStep] = table[k][lookup[canStep]] < ends[canStep]
+        pos = np.where(canStep, pos + step, pos)
+    return pos
 
 
 def addConcurrentUse(orig, startName, endName):
@@ -35,184 +63,110 @@ def addConcurrentUse(orig, startName, endName):
     Dataframe
         a new dataframe which is a copy of orig, but with an extra column used to identify concurrent use at the time of bucket assignment
     """
-    # create a dictionary of buckets, and when they will be done
-    bucketDict = {}
-
     # create the column with a obviously default number
     orig["Concurrent Usage"] = np.NaN
 
+    # Set up columns to reveal specific time overlap
+    for x in range(10):
+        orig[f"Time_{x}_Active"] = 0
+
+    # limit the calculations as much as possible, starting with just our department
+    distMask = orig["Department"].isin(ourDepartment).to_numpy()
+    if not distMask.any():
+        return orig
+    dist = orig[distMask]
+
+    # use the bucket column if it exists, since this work should already be done.
+    if "Bucket Type" in dist.columns:
+        buckets = dist["Bucket Type"]
+    else:
+        buckets = dist["Radio_Name"].apply(lambda name: u.getUnitBucket(u.getUnitType(name)))
+
+    starts = pd.to_datetime(dist[startName], errors="coerce").to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    ends = pd.to_datetime(dist[endName], errors="coerce").to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    nullStart = np.isnat(starts.view("datetime64[ns]"))
+
+    # ---------------- PRIMARY - CONCURRENT USAGE ---------------
+    # =======================================================================
+    # Rows are processed in file order.  Each row adds its end time to its bucket, and then every bucket drops the end times that are
+    # not after the current start.  A null start clears everything, and a null end is dropped immediately.
+    # So a row is still counted up until the first row (itself included) that starts at or after its end.
+    killStarts = np.where(nullStart, np.iinfo(np.int64).max, starts)
+    death = getDeathPositions(killStarts, ends)
+
+    bucketKeys = buckets.astype(str).to_numpy()
+    positions = np.arange(len(dist))
+    usage = np.empty(len(dist))
+    for bucket in np.unique(bucketKeys):
+        members = positions[bucketKeys == bucket]
+        dropped = np.sort(death[members])
+        # rows of this bucket seen so far, minus those already dropped, minus this one
+        seen = np.arange(1, len(members) + 1)
+        gone = np.searchsorted(dropped, members, side="right")
+        usage[members] = seen - gone - 1
+    orig.loc[distMask, "Concurrent Usage"] = usage
+
     # ---------------- SECONDARY - TIME IN RANGE CALCULATIONS ---------------
     # =======================================================================
-    # set up timeInterval for easier overlap detection
-
-    # dont crash the program when no close is given please...
-    def makeInterval(inc, start, end):
-        interval = pd.Interval(0, 0, closed="neither")
-        try:
-            interval = pd.Interval(start, end, closed="right")
-        except Exception as e:
-            if not (pd.isnull(start) or pd.isnull(end)):
-                print(f"{inc}: {start} - {end} : {e}")
-            else:
-                pass
-            try:
-                interval = pd.Interval(start, start, closed="right")
-            except Exception as err:
-                if not (pd.isnull(start)):
-                    print(err)
-        return interval
-
-    orig["Time_Interval"] = orig.apply(
-        lambda row: makeInterval(
-            row["Master Incident Number"], row[startName], row[endName]
-        ),
-        axis=1,
-    )
+    # intervals are (start, end].  Missing or backwards ends collapse to (start, start]
+    badEnd = ~nullStart & ((ends < starts) | np.isnat(ends.view("datetime64[ns]")))
+    for ind in dist.index[badEnd & ~np.isnat(ends.view("datetime64[ns]"))]:
+        print(f"{orig.loc[ind, 'Master Incident Number']}: {orig.loc[ind, startName]} - {orig.loc[ind, endName]} : invalid interval")
+    intervalEnds = np.where(badEnd, starts, ends)
+
+    timeActive = np.zeros((len(dist), 10), dtype=np.int64)
+    valid = buckets.notnull().to_numpy() & ~nullStart
+    for bucket in pd.unique(buckets[valid]):
+        members = positions[valid & (buckets == bucket).to_numpy()]
+        timeActive[members] = getTimes(starts[members], intervalEnds[members])
 
-    # Set up columns to reveal specific time overlap
     for x in range(10):
-        orig[f"Time_{x}_Active"] = 0
-    #  -----------------------------------------------------------------------
-
-    # limit the dictionary as much as possible, since this will go quite slow
-    # start with just our jurisdiction
-    # distArr = orig.index[(orig["Jurisdiction"].isin(["ESD02", "ESD17"]))].tolist()
-    distArr = orig.index[(orig["Department"].isin(ourDepartment))].tolist()
-    with tqdm(total=len(distArr), desc=f"Getting Concurrency") as pbar:
-        for ind in distArr:
-            # get start and end time of incident
-            startTime = orig.loc[ind, startName]
-            endTime = orig.loc[ind, endName]
-
-            # get bucket type from the name
-            # use the column if it exists, since this work should already be done.
-            try:
-                bucketType = str(orig.loc[ind, "Bucket Type"])
-            except:
-                bucketType = u.getUnitBucket(u.getUnitType(orig.loc[ind, "Radio_Name"]))
-
-            # store end time for this type into the dictionary
-            bucketDict[bucketType] = [endTime] + (
-                bucketDict[bucketType] if bucketType in bucketDict else []
-            )
-
-            # remove those that are already finished
-            recalcDict(bucketDict, startTime)
-
-            # store current count as concurrent usage
-            orig.loc[ind, "Concurrent Usage"] = (
-                len(bucketDict[bucketType])
-                - 1  # remove on since this one is being counted
-            )
-
-            # ---------------- SECONDARY - TIME IN RANGE CALCULATIONS ---------------
-            # =======================================================================
-            orig = getTimes(orig, ind, orig.loc[ind, "Time_Interval"], bucketType)
-            # =======================================================================
-            pbar.update(1)
-
-    # remove the new useless interval column
-    orig = orig.drop(
-        [
-            "Time_Interval",
-        ],
-        axis=1,
-    )
+        orig.loc[distMask, f"Time_{x}_Active"] = timeActive[:, x]
+
     return orig  # .astype({"Concurrent Usage": "Int64"})
 
 
 # ===================================
 #       SECONDARY - TIME IN RANGE CALCULATIONS
 # ===================================
-def getTimes(df, ind, interval, bucket):
+def getTimes(starts, ends):
     """
-    Get get all time breakdowns for a specific passed row of the passed DF
+    Get all time breakdowns for a single bucket in one sweep over its start/end events
+
+    Parameters
+    --------------------------------
+    starts : np.ndarray of int64
+        interval starts as nanoseconds
+    ends : np.ndarray of int64
+        interval ends as nanoseconds, never before the matching start
+
+    Returns
+    --------------------------------
+    np.ndarray
+        (rows x 10) seconds each row spent with 0-9+ other buckets of the same type active
     """
-    # filter on same bucket
-    nearbyInd = df[abs(df.index - ind) < 15]
-    commonTimes = nearbyInd[
-        (nearbyInd["Bucket Type"] == bucket)
-        & (nearbyInd["Department"].isin(ourDepartment))
-        # & (nearbyInd["include_in_concurrency"])
-    ]
-
-    # Remove broken time intervals before comparing them
-
-    # filter that on overlap times - lets use only those within 20
-    try:
-        commonTimes = commonTimes[
-            commonTimes.apply(
-                lambda row: interval.overlaps(row["Time_Interval"]), axis=1
-            )
-        ]
-    except Exception as e:
-        print(f"{ind} - {interval}")
-
-    # this should never actually happen afterall, you should ALWAYS find yourself.
-    # if commonTimes.empty:
-    #     return df
-
-    # get list of all overlapping start/end points
-    timeList = (
-        commonTimes["Unit Time Assigned"].tolist()
-        + commonTimes["Unit Time Call Cleared"].tolist()
-    )
-
-    timeList.sort()
-    # remove everything before this units start and everything after this unit end
-    # after opening set to eliminate overlap issues, the original interval now needs to be added in manually
-    tempTime = [interval.left]
-    for x in timeList:
-        if (x in interval) and (x not in tempTime):
-            tempTime.append(x)
-
-    # WTF is this list not sorted?
-
-    # print(f"---------------------------------------------------------\n{timeList}")
-    # print(f"\nfiltered:\n{tempTime}\n\n")
-
-    # use the list to group out concurrency
-    # -----------------------
-    inc = df.loc[ind, "Master Incident Number"]
-    # print(
-    #     f"==================================================================================\n----- {inc}: \n{interval}\n\n{timeList}"
-    # )
-    timeList = tempTime
-
-    timeDict = {}
-    prevTime = timeList[0]
-    # create a breakdown of
-    # skip the first, as it should always be 0 seconds
-    for time in timeList[1:]:
-        timeRange = time - prevTime
-        try:
-            setLength = (
-                commonTimes[
-                    commonTimes.apply(lambda row: time in row["Time_Interval"], axis=1)
-                ].shape[0]
-                - 1
-            )
-        except Exception as e:
-            pass
-            # show(commonTimes)I just want to finish my cabinets
-        # print(f"  {str(time):<30}: {str(timeRange):<23}-   {setLength}")
-        # max out the time to be 9+ units
-        if setLength > 9:
-            setLength = 9
-        try:
-            timeDict[setLength] += timeRange
-        except:
-            timeDict[setLength] = timeRange
-        prevTime = time
-
-    # print(timeDict)
-    for x in timeDict:
-        # store each time as seconds into the rows new fields
-        df.loc[ind, f"Time_{x}_Active"] = int(timeDict[x] / np.timedelta64(1, "s"))
-
-    # show(commonTimes)
-
-    return df
+    # every start and end is a breakpoint, and coverage is constant between breakpoints
+    points = np.unique(np.concatenate([starts, ends]))
+    startAt = np.searchsorted(points, starts)
+    endAt = np.searchsorted(points, ends)
+
+    # coverage of the segment (points[p], points[p + 1]] is every interval that started at or before p and ends after it
+    delta = np.zeros(len(points), dtype=np.int64)
+    np.add.at(delta, startAt, 1)
+    np.add.at(delta, endAt, -1)
+    coverage = np.cumsum(delta)[:-1]
+
+    # max out the count to be 9+ other units.  Segments with no coverage are never inside any interval.
+    level = np.clip(coverage - 1, 0, 9)
+    lengths = np.diff(points)
+
+    # running total of time spent at each level, so any interval can be read with a single subtraction
+    spent = np.zeros((10, len(points)), dtype=np.int64)
+    for x in range(10):
+        spent[x, 1:] = np.cumsum(np.where(level == x, lengths, 0))
+
+    # nanoseconds to whole seconds
+    return ((spent[:, endAt] - spent[:, startAt]) // 1000000000).T
 
 
 ## Main - Used for testing, and will be ignored on import.
@@ -10,6 +10,8 @@ import re
 from ServerFiles import setup_logging, get_base_dir
 from os import path
 import traceback
+import hashlib
+import timer
 
 # from pandasgui import show
 from tqdm import tqdm
@@ -22,6 +24,21 @@ from datetime import datetime
 
 logger = setup_logging("Database.log")
 
+# raw tables, and the columns identifying a row in each
+raw_tables = {
+    "ems": "RawEMS",
+    "fire": "RawFire",
+    "non_esd_ems": "NonESDEMS",  # Example table name
+    "non_esd_fire": "RawNonESDFire"
+}
+raw_primary_keys = {
+    "ems": ["Incident", "Unit", "Assigned"],
+    "fire": ["Master_Incident_Number", "Radio_Name", "Unit Time Assigned"],
+    "non_esd_fire": ["Master_Incident_Number", "Unit_Name", "Unit_Assigned_Datetime"],
+}
+# columns that are not part of a raw row's content, and so are left out of its Row_Hash
+row_hash_excluded_columns = ["Row_Hash", "PandasIndex", "index", "Master Incident Without First Two Digits"]
+
 
 class SQLDatabase:
     """a connection to a SQL Database, and associated functions for insertion of required data"""
@@ -533,6 +550,43 @@ class SQLDatabase:
         
         return formatted_str
 
+    def format_sql_param(self, item):
+        """Parameter equivalent of format_sql_values: convert a single value into something pyodbc can bind"""
+        if isinstance(item, (bool, np.bool_)):
+            return 1 if item else 0
+        elif isinstance(item, (list, dict)):
+            return json.dumps(item)
+        elif isinstance(item, np.ndarray):
+            if item.size == 1:
+                return self.format_sql_param(item[0])
+            logger.error(
+                "Item is an array with more than one element. Only single-element arrays are handled."
+            )
+            return None
+        elif pd.isnull(item):
+            return None
+        elif isinstance(item, str):
+            # keep line breaks consistent with the literal MERGE statements
+            return item.replace("\n", "| ").replace("\r", "| ")
+        elif isinstance(item, pd.Timestamp):
+            return item.to_pydatetime().replace(microsecond=0)
+        elif isinstance(item, np.generic):
+            return item.item()
+        elif isinstance(item, (int, float)):
+            return item
+        return str(item)
+
+    def format_sql_params(self, df):
+        """
+        Converts an entire DataFrame into a list of parameter tuples for executemany.
+        Conversion is done column by column, which is far cheaper than iterrows on large frames.
+        """
+        columns = [
+            [self.format_sql_param(item) for item in df[col].tolist()]
+            for col in df.columns
+        ]
+        return list(zip(*columns))
+
 
     # main reason for this... run all included functions
     def insertDF(self, df):
@@ -575,6 +629,37 @@ class SQLDatabase:
 
         return sql_df
 
+    def retrieve_chunks(self, query, date_fields, chunksize=50000, dtypes=None, categories=None):
+        """
+        Retrieves data from the database in chunks, so memory stays flat however many rows the query returns.
+
+        Parameters:
+            query (str): SQL query to be executed.
+            date_fields (list of str): List of column names that should be parsed as dates.
+            chunksize (int): Rows per chunk.
+            dtypes (dict, optional): Explicit dtypes for columns, passed on to pandas.
+            categories (list of str, optional): Low-cardinality columns (Station, Unit, Problem...) to convert to categoricals.
+
+        Yields:
+            pandas.DataFrame: Each chunk of the result.
+        """
+        print("Streaming data from Database")
+        total = 0
+        with self.engine.connect().execution_options(stream_results=True) as connection:
+            for chunk in pd.read_sql(
+                query,
+                con=connection,
+                parse_dates=date_fields,
+                chunksize=chunksize,
+                dtype=dtypes,
+            ):
+                for col in categories or []:
+                    if col in chunk.columns:
+                        chunk[col] = chunk[col].astype("category")
+                total += len(chunk)
+                yield chunk
+        print(f"Data successfully retrieved: {total} rows.")
+
     def RunFireEMSLink(self, date):
         print("Updating Fire EMS Link table for the last month...")
         fire_ems_link_procedure = f"exec linkFireEMS @lastRunDate='{date}';"
@@ -595,7 +680,7 @@ class SQLDatabase:
 
     # REWRITES
     #==========================================================================================================================================
-    def insert_dataframe(self, df, table_name, primary_keys):
+    def insert_dataframe(self, df, table_name, primary_keys, bulk=False, batch_size=5000):
         """
         Upserts a DataFrame into the specified table with error handling and logging failures.
 
@@ -603,16 +688,25 @@ class SQLDatabase:
             df (pandas.DataFrame): DataFrame to upsert.
             table_name (str): Table name to upsert into.
             primary_keys (list): List of column names to be used as primary keys.
+            bulk (bool): Stage the frame in a temp table and MERGE it in set-based batches instead of one statement per row.
+            batch_size (int): Rows per staged MERGE when bulk is enabled.
+
+        Returns:
+            pandas.DataFrame: One row per failed insert/update, with the DataFrame index and the error.
         """
         # Converting boolean columns to 1/0 for SQL Server BIT type compatibility
         bool_columns = [col for col, dtype in df.dtypes.items() if dtype == "bool"]
         for col in bool_columns:
             df[col] = df[col].astype(int)
 
+        if bulk:
+            return self.bulk_insert_dataframe(df, table_name, primary_keys, batch_size)
+
         Session = sessionmaker(bind=self.engine)
         session = Session()
 
         failed_rows = []
+        failures = []
         for index, row in tqdm(df.iterrows(), total=len(df), desc=f"Upserting to {table_name}"):
             values = self.format_sql_values(row.values)
             primary_key_condition = " AND ".join(
@@ -648,49 +742,275 @@ class SQLDatabase:
                     logger.error(f"Failed to insert/update row {index}: {e}")
                     # logger.error(f"SQL Statement: {stmt}")  # Log the full SQL statement
                 failed_rows.append(index)
+                failures.append({"index": index, "error": simple_error or str(e)})
 
         if failed_rows:
             logger.info(f"Failed rows are logged. Row indices: {failed_rows}")
         session.close()
+        return pd.DataFrame(failures, columns=["index", "error"])
 
-    def insertESOBasic(self, df):
+    def bulk_insert_dataframe(self, df, table_name, primary_keys, batch_size=5000):
+        """
+        Set-based alternative to the row by row upsert in insert_dataframe.
+        Each batch is written to a temp table with fast_executemany, and then merged into the target with a single MERGE.
+        If a batch fails, it is retried one row at a time so the offending rows can be reported.
+
+        Parameters:
+            df (pandas.DataFrame): DataFrame to upsert.
+            table_name (str): Table name to upsert into.
+            primary_keys (list): List of column names to be used as primary keys.
+            batch_size (int): Rows per staged MERGE.
+
+        Returns:
+            pandas.DataFrame: One row per failed insert/update, with the DataFrame index and the error.
+        """
+        stage_table = "#UpsertStage"
+        insert_cols = ", ".join([f"[{col}]" for col in df.columns])
+        placeholders = ", ".join(["?" for _ in df.columns])
+        primary_key_condition = " AND ".join(
+            [f"target.[{pk}] = source.[{pk}]" for pk in primary_keys]
+        )
+        update_set = ", ".join(
+            [
+                f"target.[{col}] = source.[{col}]"
+                for col in df.columns
+                if col not in primary_keys
+            ]
+        )
+        source_cols = ", ".join([f"source.[{col}]" for col in df.columns])
+
+        stage_stmt = f"INSERT INTO {stage_table} ({insert_cols}) VALUES ({placeholders})"
+        merge_stmt = f"""
+        MERGE INTO {table_name} AS target
+        USING {stage_table} AS source
+        ON {primary_key_condition}
+        WHEN MATCHED THEN
+            UPDATE SET {update_set}
+        WHEN NOT MATCHED THEN
+            INSERT ({insert_cols}) VALUES ({source_cols});
+        """
+
+        # A MERGE cannot touch the same target row twice.  Row by row, the last duplicate would win, so keep that one.
+        df = df.drop_duplicates(subset=primary_keys, keep="last")
+        params = self.format_sql_params(df)
+        indexes = df.index.tolist()
+
+        failures = []
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.fast_executemany = True
+            # a pooled connection may still hold the stage table of an upsert that failed part way
+            cursor.execute(f"IF OBJECT_ID('tempdb..{stage_table}') IS NOT NULL DROP TABLE {stage_table}")
+            # Copy column types from the target, so the driver binds exactly as the table expects
+            cursor.execute(f"SELECT TOP 0 {insert_cols} INTO {stage_table} FROM {table_name}")
+            conn.commit()
+
+            def merge_rows(rows):
+                cursor.execute(f"TRUNCATE TABLE {stage_table}")
+                cursor.executemany(stage_stmt, rows)
+                cursor.execute(merge_stmt)
+                conn.commit()
+
+            for start in tqdm(range(0, len(params), batch_size), desc=f"Bulk Upserting to {table_name}"):
+                batch = params[start : start + batch_size]
+                try:
+                    merge_rows(batch)
+                except Exception as e:
+                    conn.rollback()
+                    logger.warning(
+                        f"Batch starting at row {start} failed for {table_name}, retrying row by row: {self.check_simple_errors(e) or e}"
+                    )
+                    for offset, row in enumerate(batch):
+                        index = indexes[start + offset]
+                        try:
+                            merge_rows([row])
+                        except Exception as row_error:
+                            conn.rollback()
+                            simple_error = self.check_simple_errors(row_error)
+                            if simple_error:
+                                logger.error(f"Simple Error for row {index}: {simple_error}")
+                            else:
+                                logger.error(f"Failed to insert/update row {index}: {row_error}")
+                            failures.append({"index": index, "error": simple_error or str(row_error)})
+        finally:
+            # always drop the stage table, so it never outlives this upsert on the pooled connection
+            try:
+                # anything left uncommitted by an error is discarded, not committed along with the drop
+                conn.rollback()
+                cursor = conn.cursor()
+                cursor.execute(f"IF OBJECT_ID('tempdb..{stage_table}') IS NOT NULL DROP TABLE {stage_table}")
+                conn.commit()
+            except Exception as e:
+                logger.warning(f"Could not drop {stage_table}: {e}")
+            conn.close()
+
+        if failures:
+            logger.info(f"Failed rows are logged. Row indices: {[f['index'] for f in failures]}")
+        return pd.DataFrame(failures, columns=["index", "error"])
+
+    def insertESOBasic(self, df, bulk=False):
         """
         Inserts or updates entries into the 'Basic' table using 'IncidentId' as the primary key.
         """
-        self.insert_dataframe(df, "Basic", ["IncidentId"])
+        return self.insert_dataframe(df, "Basic", ["IncidentId"], bulk=bulk)
+
+    def format_hash_value(self, item):
+        """Convert a single value to the text it is hashed as, so it hashes the same from a file or from the database"""
+        if isinstance(item, (bool, np.bool_)):
+            return "1" if item else "0"
+        elif isinstance(item, (list, dict)):
+            return json.dumps(item)
+        elif pd.isnull(item):
+            return ""
+        elif isinstance(item, (datetime, np.datetime64)):
+            return pd.Timestamp(item).round("s").strftime("%Y-%m-%d %H:%M:%S")
+        elif isinstance(item, (int, float, np.number)):
+            return "%.15g" % item
+        return str(item).strip()
+
+    def format_hash_column(self, col):
+        """Column equivalent of format_hash_value, vectorized for the common column types"""
+        if pd.api.types.is_bool_dtype(col):
+            return col.map(self.format_hash_value)
+        if pd.api.types.is_datetime64_any_dtype(col):
+            return col.dt.round("s").dt.strftime("%Y-%m-%d %H:%M:%S").fillna("")
+        if pd.api.types.is_numeric_dtype(col):
+            values = col.astype(float).to_numpy()
+            text = np.char.mod("%.15g", values).astype(object)
+            text[np.isnan(values)] = ""
+            return pd.Series(text, index=col.index)
+        return col.map(self.format_hash_value)
+
+    def hash_keys(self, df, primary_keys):
+        """Returns the primary keys of each row as one string, formatted the same as they are hashed"""
+        keys = pd.Series("", index=df.index)
+        for pk in primary_keys:
+            keys = keys + self.format_hash_column(df[pk]) + "\x1f"
+        return keys
+
+    def row_hashes(self, df, primary_keys):
+        """
+        Returns a stable fingerprint of the content of each row: every column other than the primary keys, normalized and hashed.
+
+        Parameters:
+            df (pandas.DataFrame): raw rows.
+            primary_keys (list): columns identifying each row, which are left out of the hash.
+
+        Returns:
+            pandas.Series: 16 character hex digest for each row.
+        """
+        columns = sorted(
+            col for col in df.columns
+            if col not in primary_keys and col not in row_hash_excluded_columns
+        )
+        content = pd.Series("", index=df.index)
+        for col in columns:
+            content = content + f"{col}=" + self.format_hash_column(df[col]) + "\x1f"
+        return content.map(lambda text: hashlib.blake2b(text.encode(), digest_size=8).hexdigest())
+
+    def ensure_row_hash_column(self, table_name):
+        """Add the Row_Hash column to a raw table, if it is not there yet"""
+        with self.engine.connect().execution_options(autocommit=True) as connection:
+            connection.execute(
+                f"IF COL_LENGTH('{table_name}', 'Row_Hash') IS NULL ALTER TABLE [{table_name}] ADD [Row_Hash] char(16) NULL;"
+            )
+
+    def get_raw_rows(self, table_type, incidents, columns=None, batch_size=1000):
+        """
+        Retrieve the raw rows for the given incidents.
+
+        Parameters:
+            table_type (str): "ems", "fire", or "non_esd_fire".
+            incidents (iterable): incident numbers to retrieve.
+            columns (list, optional): columns to retrieve.  Every column when None.
+            batch_size (int): incidents per query.
+
+        Returns:
+            pandas.DataFrame: the raw rows.
+        """
+        primary_keys = raw_primary_keys[table_type]
+        select = "*" if columns is None else ", ".join(f"[{col}]" for col in columns)
+        incidents = [str(i).replace("'", "''") for i in pd.unique(pd.Series(incidents).dropna())]
+        frames = []
+        for start in range(0, len(incidents), batch_size):
+            in_list = ", ".join(f"'{i}'" for i in incidents[start:start + batch_size])
+            frames.append(
+                self.retrieve_df(
+                    f"SELECT {select} FROM [{raw_tables[table_type]}] WHERE [{primary_keys[0]}] IN ({in_list})",
+                    [],
+                )
+            )
+        if not frames:
+            return pd.DataFrame(columns=primary_keys if columns is None else columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def get_raw_hashes(self, table_type, incidents, batch_size=1000):
+        """
+        Retrieve only the primary keys and Row_Hash of the raw rows for the given incidents.
+
+        Parameters:
+            table_type (str): "ems", "fire", or "non_esd_fire".
+            incidents (iterable): incident numbers to retrieve.
+            batch_size (int): incidents per query.
+
+        Returns:
+            pandas.DataFrame: primary key columns and Row_Hash.
+        """
+        columns = raw_primary_keys[table_type] + ["Row_Hash"]
+        return self.get_raw_rows(table_type, incidents, columns, batch_size)
+
+    def drop_unchanged_raw(self, df, table_type):
+        """Returns df without the rows whose Row_Hash matches the row already stored under the same keys"""
+        primary_keys = raw_primary_keys[table_type]
+        existing = self.get_raw_hashes(table_type, df[primary_keys[0]])
+        if existing.empty or "Row_Hash" not in existing:
+            return df
+        stored = dict(zip(self.hash_keys(existing, primary_keys), existing["Row_Hash"]))
+        unchanged = self.hash_keys(df, primary_keys).map(stored) == df["Row_Hash"]
+        logger.info(f"Skipping {unchanged.sum()} unchanged of {len(df)} raw rows")
+        return df[~unchanged]
+
+    def UpsertRaw(self, df, table_type, bulk=False, skip_unchanged=False):
+        """
+        Upsert raw file rows, with a Row_Hash of each row's content.
 
-    def UpsertRaw(self, df, table_type):
+        Parameters:
+            df (pandas.DataFrame): raw rows.
+            table_type (str): "ems", "fire", "non_esd_ems", or "non_esd_fire".
+            bulk (bool): passed on to insert_dataframe.
+            skip_unchanged (bool): fetch the stored (keys, Row_Hash) first, and only upsert rows that are new or changed.
+        """
         if table_type not in ["ems", "fire", "non_esd_ems", "non_esd_fire"]:
             logger.error(f"ERROR! - No raw table for: {table_type}")
             return
 
-        table_map = {
-            "ems": "RawEMS",
-            "fire": "RawFire",
-            "non_esd_ems": "NonESDEMS",  # Example table name
-            "non_esd_fire": "RawNonESDFire"
-        }
-
         try:
-            table_name = table_map.get(table_type)
+            table_name = raw_tables.get(table_type)
         except Exception as e:
             logger.error(f"Table {table_name} does not exist.")
             return
 
+        if table_type not in raw_primary_keys:
+            return
+
         # DONT manipulate the DF - keep the function pure!
         if table_type == "ems":
             temp = df
             temp["PandasIndex"] = temp.index
-            self.insert_dataframe(df, table_name, ["Incident", "Unit", "Assigned"])
-        elif table_type in ["non_esd_fire"]:
-            self.insert_dataframe(df, table_name, ["Master_Incident_Number", "Unit_Name", "Unit_Assigned_Datetime"])
         elif table_type in ["fire"]:
             prepreprocess = {
             # Aug 28 2023, dispatch renamed a column.  Fixing that here.
             "Alarm_Level": "Alarm Level",
             }
             df = df.rename(columns=prepreprocess, errors="ignore")
-            self.insert_dataframe(df, table_name, ["Master_Incident_Number", "Radio_Name", "Unit Time Assigned"])
+
+        primary_keys = raw_primary_keys[table_type]
+        df = df.assign(Row_Hash=self.row_hashes(df, primary_keys))
+        self.ensure_row_hash_column(table_name)
+        if skip_unchanged:
+            df = self.drop_unchanged_raw(df, table_type)
+        return self.insert_dataframe(df, table_name, primary_keys, bulk=bulk)
 
     def fire_data_corrections(self, df):
         # force format:
@@ -702,26 +1022,27 @@ class SQLDatabase:
             logger.error(f"Failed: to insert into EMS Incidents: {tb}")
         return df
     
-    def new_insert_DF(self, df, data_source):
+    @timer.profiler.profiled("new_insert_DF")
+    def new_insert_DF(self, df, data_source, bulk=False):
         if data_source == "ems":
-            try: self.new_insertToEMSIncident(df)
+            try: self.new_insertToEMSIncident(df, bulk)
             except Exception as e:
                 tb = traceback.format_exc()  # This captures the entire traceback as a string
                 logger.error(f"Failed: to insert into EMS Incidents: {tb}")
 
-            try: self.new_insertToEMSUnits(df)
+            try: self.new_insertToEMSUnits(df, bulk)
             except Exception as e:
                 tb = traceback.format_exc()  # This captures the entire traceback as a string
                 logger.error(f"Failed: to insert into EMS Units: {tb}")
             
         else:
             df = self.fire_data_corrections(df)
-            try: self.new_insertToFireIncident(df)
+            try: self.new_insertToFireIncident(df, bulk)
             except Exception as e:
                 tb = traceback.format_exc()  # This captures the entire traceback as a string
                 logger.error(f"Failed: to insert into Fire Incidents: {tb}")
 
-            try: self.new_insertToFireUnits(df)
+            try: self.new_insertToFireUnits(df, bulk)
             except Exception as e:
                 tb = traceback.format_exc()  # This captures the entire traceback as a string
                 logger.error(f"Failed: to insert into Fire Units: {tb}")
@@ -730,7 +1051,7 @@ class SQLDatabase:
 
         return None
 
-    def new_insertToFireIncident(self, df):
+    def new_insertToFireIncident(self, df, bulk=False):
         # get array of unique incident numbers
         required_columns = [
             "Incident_Number",
@@ -796,9 +1117,9 @@ class SQLDatabase:
         uniqueIncidents = uniqueIncidents.drop_duplicates(subset=["Incident_Number"])
 
         logger.info("Inserting Unique incidents")
-        self.insert_dataframe(uniqueIncidents, "FireIncidents", ["Incident_Number"])
+        self.insert_dataframe(uniqueIncidents, "FireIncidents", ["Incident_Number"], bulk=bulk)
 
-    def new_insertToEMSIncident(self, df):
+    def new_insertToEMSIncident(self, df, bulk=False):
         # get array of unique incident numbers
         required_columns = [
             "Incident_Number",
@@ -872,7 +1193,7 @@ class SQLDatabase:
 
         logger.info("Inserting unique incident list")
         # self.insertToTable(uniqueIncidents, "EMSIncidents")
-        self.insert_dataframe(uniqueIncidents, "EMSIncidents", ["Incident_Number"])
+        self.insert_dataframe(uniqueIncidents, "EMSIncidents", ["Incident_Number"], bulk=bulk)
 
     def special_conversions(self, df):
         # Special handling for 'Is_Closest_Station' if it exists in DataFrame
@@ -880,7 +1201,7 @@ class SQLDatabase:
             df['Is_Closest_Station'] = df['Is_Closest_Station'].replace({True: 1, False: 0})
         return(df)
 
-    def new_insertToFireUnits(self, df):
+    def new_insertToFireUnits(self, df, bulk=False):
         # get array of unique incident numbers
         unitCalls = df[
             [
@@ -928,9 +1249,9 @@ class SQLDatabase:
         # show(unitCalls)
         # self.insertToTable(unitCalls, "FireUnits")
         unitCalls = self.special_conversions(unitCalls)
-        self.insert_dataframe(unitCalls, "FireUnits", ["Incident_Number","Unit","Unit_Assigned"])
+        self.insert_dataframe(unitCalls, "FireUnits", ["Incident_Number","Unit","Unit_Assigned"], bulk=bulk)
 
-    def new_insertToEMSUnits(self, df):
+    def new_insertToEMSUnits(self, df, bulk=False):
         # get array of unique incident numbers
         unitCalls = df[
             [
@@ -994,7 +1315,7 @@ class SQLDatabase:
         # show(unitCalls)
         # self.insertToTable(unitCalls, "EMSUnits")
         unitCalls = self.special_conversions(unitCalls)
-        self.insert_dataframe(unitCalls, "EMSUnits", ["Incident_Number","Unit","Unit_Assigned"])
+        self.insert_dataframe(unitCalls, "EMSUnits", ["Incident_Number","Unit","Unit_Assigned"], bulk=bulk)
 
     # ======================================================================================
     # Google Form Insertions
@@ -1,5 +1,6 @@
 # Built in
 import datetime
+import re
 
 # Dependancies
 import pandas as pd
@@ -7,7 +8,6 @@ import numpy as np
 
 from shapely.geometry import Point
 import geopandas as gpd
-import geopy.distance
 
 # Sibling Modules
 from crf import getCRF
@@ -20,6 +20,8 @@ import naming as n
 import os
 from os import path
 import geocode
+import boundaries
+import timer
 
 # Setup Logging for the remainder of the data
 import ServerFiles as sf
@@ -93,60 +95,51 @@ def addIsClosestStation(df):
     return df
 
 
-def getLoc(unit_location, data_source, locations, x_long=None, y_lat=None, stationDict=None):
+class LocationMatcher:
     """
-    Determine the station based on location description or GPS coordinates.
+    Index of the street names in locations.json, for finding which station a location description is near.
 
-    Parameters:
-    - unit_location: The location of the unit at assign.
-    - data_source: 'fire' or 'ems'
-    - x_long: Longitude coordinate of GPS at unit assign (optional).
-    - y_lat: Latitude coordinate of GPS at unit assign (optional).
-    - locations: a dict of street names, and their associated stations
-    - stationDict: Dictionary of station details including GPS coordinates (optional).
-
-    Returns:
-    - The determined station or None if no match is found.
-    """
-    # print(f"{unit_location}, {data_source}, ({x_long}, {y_lat})")
-    if x_long is not None and y_lat is not None and stationDict is not None:
-        # print(f"debug: checking GPS of EMS Units: {y_lat} , {x_long}")
-        for station, data in stationDict.items():
-            if is_near_station((y_lat, x_long), data["gps"]):
-                # print(f"Debug: Location match found for station {station}")
-                return station
-
-    current_location = str(unit_location).lower()
-    stationNum = None
-    if "fs020" in current_location or "esd2 - station 2" in current_location:
-        stationNum = "S" + current_location[-2:]
-    elif data_source == 'fire':
-        for street in locations.keys():
-            if street.lower() in current_location:
-                stationNum = locations[street]
-                break
-    # print(f"Debug: Location match not found for station")
-    return stationNum
-
-
-def getLocAtAssign(station, unit_location, data_source, locations, x_long=None, y_lat=None, stationDict=None):
+    The streets are compiled into a single pattern once, longest first, so the longest street found at the
+    earliest position of a location wins.  Every distinct location is only matched once, and kept for later frames.
     """
-    Check if the unit was assigned at its station.
 
-    Parameters:
-    - station: The station to check.
-    - unit_location: The location of the unit at assign.
-    - data_source: 'fire' or 'ems'
-    - locations: a dict of street names, and their associated stations
-    - x_long: Longitude coordinate of GPS at unit assign (optional).
-    - y_lat: Latitude coordinate of GPS at unit assign (optional).
-    - stationDict: Dictionary of station details including GPS coordinates (optional).
+    def __init__(self, locations):
+        self.stations = {}
+        for street, station in locations.items():
+            self.stations.setdefault(street.lower(), station)
+        streets = sorted(self.stations, key=len, reverse=True)
+        self.pattern = (
+            re.compile("(" + "|".join(re.escape(street) for street in streets) + ")")
+            if streets
+            else None
+        )
+        # {lowercase location: station, or NaN if no street matched}
+        self.matched = {}
+
+    def match(self, current):
+        """
+        Returns the station of every lowercase location in a Series, NaN where no street matches
+        """
+        unmatched = pd.Series(current[~current.isin(self.matched.keys())].unique(), dtype=object)
+        if len(unmatched):
+            if self.pattern is None:
+                stations = pd.Series(np.nan, index=unmatched.index, dtype=object)
+            else:
+                stations = unmatched.str.extract(self.pattern, expand=False).map(self.stations)
+            self.matched.update(zip(unmatched, stations))
+        return current.map(self.matched)
+
+
+# one matcher for each locations dict used, so every frame shares the same index and matches
+locationMatchers = {}
+
+
+def getLocationMatcher(locations):
+    key = tuple(locations.items())
+    if key not in locationMatchers:
+        locationMatchers[key] = LocationMatcher(locations)
+    return locationMatchers[key]
 
-    Returns:
-    - True if the unit was assigned at its station, False otherwise.
-    """
-    assigned_station = getLoc(unit_location, data_source, locations, x_long, y_lat, stationDict)
-    return station == assigned_station
 
 def addLocAtAssignToDF(df, data_source, locations, stationDict):
     """
@@ -162,138 +155,188 @@ def addLocAtAssignToDF(df, data_source, locations, stationDict):
     """
     print("Begin Analyzing Location Assigned:\n================================================")
     if "Location_At_Assign_Time" in df.columns:
-        df["Assigned at Station"] = df.apply(
-            lambda row: getLocAtAssign(
-                row["Station"], 
-                row["Location_At_Assign_Time"],
-                data_source,
-                locations, 
-                row.get("Longitude_at_Assign"), 
-                row.get("Latitude_at_Assign"), 
-                stationDict
-            ),
-            axis=1,
+        df["Assigned at Station"] = df["Station"] == getLocs(
+            df, data_source, locations, stationDict
         )
     else:
         df["Assigned at Station"] = "Unknown"
     return df
 
 
-def assign_reserve_to_station(row, dataSource, stationDict, specialUnits, locations):
+# Frontline_Status values which are not units at all
+notUnits = [
+    "Not a unit",
+    "Rescue Talk Group 1",
+    "Rescue Talk Group 2",
+    "Rescue Talk Group 3",
+    "Rescue Talk Group 4",
+    "MCOT",
+    "",
+]
+
+# departments reported under a shorter name
+otherUnits = {
+    "ESD12 - Manor": "ESD12 Manor",
+    "WC - Round Rock": "RRFD",
+}
+
+# Frontline_Status values of other departments' units which are not frontline
+nonFrontline = [
+    "Command",
+    "Other",
+    "Support",
+    "Clinical Practice",
+    "Special Events Medic",
+    "Emergency Support Unit",
+    "Paramedic Practitioner Resp",
+    "Aid Unit",
+    "Administrative Support",
+    "Administrative Staff",
+]
+
+
+def haversineMiles(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in miles, broadcast over arrays of coordinates (ie: a column of units against a row of stations)
     """
-    Assigns a reserve unit to a station based on GPS coordinates, location, special units, and response box.
+    lat1, lon1, lat2, lon2 = (np.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * 3958.8 * np.arcsin(np.sqrt(a))
+
+
+def nearestStations(lats, longs, stationDict, threshold=0.1):
+    """
+    Find the nearest station to every set of coordinates, computing the whole unit x station distance matrix at once.
 
     Parameters:
-    - row: The DataFrame row containing incident details.
+    - lats: Latitudes of the units (array-like, nulls are never near a station).
+    - longs: Longitudes of the units.
     - stationDict: Dictionary of station details including GPS coordinates.
-    - specialUnits: Dictionary of special units and their corresponding stations.
-    - locations: a dict of street names, and their associated stations
+    - threshold: Distance in miles a unit must be within to be at a station.
 
     Returns:
-    - The assigned station or 'UNKNOWN' if no match is found.
+    - An object array of the nearest station within the threshold, None where there is none.
+    """
+    lats = pd.to_numeric(pd.Series(lats), errors="coerce").to_numpy(dtype=float)
+    longs = pd.to_numeric(pd.Series(longs), errors="coerce").to_numpy(dtype=float)
+    stations = np.full(len(lats), None, dtype=object)
+    if not stationDict or not len(lats):
+        return stations
+
+    names = np.array(list(stationDict), dtype=object)
+    gps = np.array([data["gps"] for data in stationDict.values()], dtype=float)
+    distances = haversineMiles(lats[:, None], longs[:, None], gps[:, 0], gps[:, 1])
+    # nan distances (missing coordinates) are never near
+    distances = np.where(np.isnan(distances), np.inf, distances)
+    nearest = distances.argmin(axis=1)
+    found = distances[np.arange(len(lats)), nearest] < threshold
+    stations[found] = names[nearest[found]]
+    return stations
+
+
+def getLocs(df, data_source, locations, stationDict=None):
     """
-    radioName = row["Radio_Name"]
-    afd_response_box = row.get("AFD Response Box")
-    x_long = row.get("Longitude_at_Assign")
-    y_lat = row.get("Latitude_at_Assign")
-    unit_location = row["Location_At_Assign_Time"]
+    Determine the station of every row of a frame based on location description or GPS coordinates.
 
-    # Use getLoc to determine the station based on GPS or address
-    stationNum = getLoc(unit_location, dataSource, locations, x_long, y_lat, stationDict)
-    if stationNum:
-        return stationNum
+    Parameters:
+    - df: DataFrame with Location_At_Assign_Time, and optionally Longitude_at_Assign and Latitude_at_Assign
+    - data_source: 'fire' or 'ems'
+    - locations: a dict of street names, and their associated stations
+    - stationDict: Dictionary of station details including GPS coordinates (optional).
 
-    # Check if unit is listed in special units
-    if radioName in specialUnits:
-        return specialUnits[radioName]
-
-    # Check the AFD response box
-    if afd_response_box:
-        # Parse the AFD response box to extract station information
-        parts = afd_response_box.split("-")
-        if len(parts) == 2:
-            _, first_station = parts
-            return f"S{first_station[:2].zfill(2)}"
-
-    return "UNKNOWN"
-
-def stationName(row, dataSource, ourNames, stationDict, locations, reserveUnits, specialUnits):
-    
-    department = row["Department"]
-    radioName = row["Radio_Name"]
-
-    # Exclude non-unit frontline statuses
-    notUnits = [
-        "Not a unit",
-        "Rescue Talk Group 1",
-        "Rescue Talk Group 2",
-        "Rescue Talk Group 3",
-        "Rescue Talk Group 4",
-        "MCOT",
-        ""
-    ]
-    if row["Frontline_Status"] in notUnits:
-        return "Not a unit"
+    Returns:
+    - A Series of the determined stations, None where no match is found.
+    """
+    stations = pd.Series(None, index=df.index, dtype=object)
+    if stationDict and {"Longitude_at_Assign", "Latitude_at_Assign"} <= set(df.columns):
+        stations[:] = nearestStations(
+            df["Latitude_at_Assign"], df["Longitude_at_Assign"], stationDict
+        )
 
-    otherUnits = {
-        "ESD12 - Manor": "ESD12 Manor",
-        "WC - Round Rock": "RRFD",
-    }
-    # Handle private ambulance providers
-    if row["Frontline_Status"] == "Private Ambulance Provider" or "ALG" in str(radioName):
-        return "Private"
+    current = df["Location_At_Assign_Time"].astype(str).str.lower()
+    atStation2 = current.str.contains("fs020", regex=False) | current.str.contains(
+        "esd2 - station 2", regex=False
+    )
+    byLocation = pd.Series(None, index=df.index, dtype=object)
+    byLocation[atStation2] = "S" + current[atStation2].str[-2:]
+    if data_source == "fire":
+        byLocation[~atStation2] = getLocationMatcher(locations).match(current[~atStation2])
 
-    # Handle our own units
-    if department in ourNames:
-        # Handle non-frontline units
-        if row["Frontline_Status"] in ["Other", "Command"]:
-            return "Admin"
+    return stations.where(stations.notnull(), byLocation)
 
-        # Check reserve units
-        if radioName in reserveUnits:
-            return assign_reserve_to_station(row, dataSource, stationDict, specialUnits, locations)
 
-        # Check special units
-        if radioName in specialUnits:
-            return specialUnits[radioName]
+def assign_reserves_to_stations(df, dataSource, stationDict, specialUnits, locations):
+    """
+    Assigns reserve units to a station based on GPS coordinates, location, special units, and response box.
 
-        # Default for our own frontline units
-        return f"S0{radioName[-2]}"
-
-    # Handle other units
-    outsiders = otherUnits.get(department, department)
-    nonFrontline = [
-        "Command",
-        "Other",
-        "Support",
-        "Clinical Practice",
-        "Special Events Medic",
-        "Emergency Support Unit",
-        "Paramedic Practitioner Resp",
-        "Aid Unit",
-        "Administrative Support",
-        "Administrative Staff",
-    ]
-    if row["Frontline_Status"] in nonFrontline:
-        outsiders += " Other"
+    Parameters:
+    - df: The DataFrame rows of reserve units.
+    - stationDict: Dictionary of station details including GPS coordinates.
+    - specialUnits: Dictionary of special units and their corresponding stations.
+    - locations: a dict of street names, and their associated stations
 
-    return outsiders
+    Returns:
+    - A Series of the assigned stations, 'UNKNOWN' where no match is found.
+    """
+    # Use getLocs to determine the station based on GPS or address
+    stations = getLocs(df, dataSource, locations, stationDict)
 
+    # Check if unit is listed in special units
+    stations = stations.where(stations.notnull(), df["Radio_Name"].map(specialUnits))
+
+    # Check the AFD response box, ie: 'AFD-0504' is first due from station 05
+    if "AFD Response Box" in df.columns:
+        parts = df["AFD Response Box"].astype(object).str.split("-")
+        firstStation = "S" + parts.str[1].str[:2].str.zfill(2)
+        stations = stations.where(
+            stations.notnull(), firstStation.where(parts.str.len() == 2)
+        )
+
+    return stations.fillna("UNKNOWN")
 
-def is_near_station(unit_coords, station_coords, threshold=0.1):
-    """
-    Check if the unit's coordinates are within a certain distance of the station coordinates.
-    """
-    if pd.isnull(unit_coords[0]) or pd.isnull(unit_coords[1]):
-        return False
-    distance = geopy.distance.distance(unit_coords, station_coords).miles
-    return distance < threshold
 
 def getStations(fireDF, dataSource, ourNames, stationDict, locations, reserveUnits, specialUnits):
-    def apply_station_name(row):
-        return stationName(row, dataSource, ourNames, stationDict, locations, reserveUnits, specialUnits)
-    
-    fireDF["Station"] = fireDF.apply(apply_station_name, axis=1)
+    status = fireDF["Frontline_Status"]
+    department = fireDF["Department"]
+    radioName = fireDF["Radio_Name"]
+
+    ours = department.isin(ourNames)
+    reserve = ours & radioName.isin(reserveUnits)
+    outsiders = department.replace(otherUnits)
+
+    # in order of precedence: the first condition a row meets picks its station
+    conditions = [
+        # Exclude non-unit frontline statuses
+        status.isin(notUnits),
+        # Handle private ambulance providers
+        (status == "Private Ambulance Provider")
+        | radioName.astype(str).str.contains("ALG", regex=False),
+        # Handle our own non-frontline units
+        ours & status.isin(["Other", "Command"]),
+        # Check reserve units
+        reserve,
+        # Check special units
+        ours & radioName.isin(list(specialUnits)),
+        # Default for our own frontline units
+        ours,
+        # Handle other non-frontline units
+        status.isin(nonFrontline),
+    ]
+    choices = [
+        "Not a unit",
+        "Private",
+        "Admin",
+        assign_reserves_to_stations(
+            fireDF[reserve], dataSource, stationDict, specialUnits, locations
+        ).reindex(fireDF.index),
+        radioName.map(specialUnits),
+        "S0" + radioName.astype(str).str[-2],
+        outsiders + " Other",
+    ]
+    fireDF["Station"] = np.select(conditions, choices, default=outsiders)
     fireDF = utils.putColAt(fireDF, ["Station", "Status"], 0)
     return fireDF
 
@@ -303,25 +346,14 @@ def getStations(fireDF, dataSource, ourNames, stationDict, locations, reserveUni
 
 def addFirstArrived(df):
     df["FirstArrived"] = False
-    # get array of unique Incidents
-    unique_incidents = df["Master Incident Number"].unique()
-    # for each incident, get array of calls
-    for incident in unique_incidents:
-        incident_data = df[df["Master Incident Number"] == incident]
-        try:
-            # get earliest arrival (either index of earliest, or null if not exits)
-            first = incident_data[
-                incident_data["Unit Time Arrived At Scene"]
-                == incident_data["Unit Time Arrived At Scene"].min()
-            ].index[0]
-            # and set earliest arrival of all for incident as 'FirstArrived' if it is less than firstUnitArrived (accounts for out of jurisdiction other units)
-            if (
-                df.loc[first, "Unit Time Arrived At Scene"]
-                <= df.loc[first, "Time First Real Unit Arrived"]
-            ):
-                df.loc[first, "FirstArrived"] = True
-        except:
-            pass
+    arrived = df[df["Unit Time Arrived At Scene"].notnull()]
+    # index of the earliest arrival of each incident (the first listed, on ties)
+    first = arrived.groupby("Master Incident Number")["Unit Time Arrived At Scene"].idxmin()
+    # and set earliest arrival of all for incident as 'FirstArrived' if it is less than firstUnitArrived (accounts for out of jurisdiction other units)
+    df.loc[first, "FirstArrived"] = (
+        df.loc[first, "Unit Time Arrived At Scene"]
+        <= df.loc[first, "Time First Real Unit Arrived"]
+    )
     return df
 
 
@@ -347,6 +379,80 @@ def reprocessPriority(df):
 
     return df
 
+def recalcFromStaged(df, rows, flagCol, recalcCols, staged):
+    """
+    Flag rows as staged as arrived, and recalculate their intervals from the staged time instead of the arrived time
+
+    :param df: Panda Dataframe, updated in place
+    :param rows: index of the rows to recalculate
+    :param flagCol: str, the column set to 1 on those rows
+    :param recalcCols: {str: [str, bool]}, the column to recalculate: [the column to get the diff from, reverse order]
+    :param staged: str, the staged time column
+    """
+    # update every recalculated column for all staged rows at once, instead of cell by cell
+    df.loc[rows, flagCol] = 1
+    for col, (other, reverse) in recalcCols.items():
+        if not reverse:
+            res = df.loc[rows, staged] - df.loc[rows, other]
+        else:
+            res = df.loc[rows, other] - df.loc[rows, staged]
+        # Convert to seconds
+        df.loc[rows, col] = res / np.timedelta64(1, "s")
+
+
+def addStatus(df):
+    """
+    Set the Status of every row of a frame sorted by incident, with the first (earliest arrived) unit of each incident first
+
+    1 - the first unit of an incident
+    0 - all other units of an incident - multi unit response
+    C - the first unit of an incident canceled prior to unit arrival (no 'Unit Time Arrived At Scene')
+    X - all other units of a canceled incident
+    """
+    # Set Canceled, 1(first arrived), or 0(multi incident)
+    conditions = [
+        (df["Master Incident Number"] != df.shift(1)["Master Incident Number"])
+        & (df["Unit Time Arrived At Scene"].isnull()),
+        (df["Master Incident Number"] == df.shift(1)["Master Incident Number"]),
+    ]
+    choices = ["C", "0"]
+    df["Status"] = np.select(conditions, choices, default="1")
+
+    # Overwrite 0 with X on canceled calls
+    # every run of an incident starts with a C or 1, followed by its 0s: carry the start of the run forward over them
+    incidentStart = df["Status"].where(df["Status"] != "0").ffill()
+    df.loc[(df["Status"] == "0") & (incidentStart == "C"), "Status"] = "X"
+    return df
+
+
+def fixTransportStatus(df, ourNames):
+    """
+    Mark EMS units which transported, but have no on scene time, as on scene
+    """
+    # all incidents where unit time arrived and scene is null, but the unit transported
+    transportCheck = (pd.isnull(df["Unit Time Arrived At Scene"])) & (
+        df["Transport_Count"] > 0
+    )
+    # our only unit on the call
+    ourOnlyUnit = (
+        transportCheck
+        & (df["Incident Call Count"] == 1)
+        & df["Department"].isin(ourNames)
+    )
+
+    # Set Status...
+    df.loc[transportCheck, "Status"] = "0"
+    df.loc[ourOnlyUnit, "Status"] = "1"
+
+    # Response Status
+    df.loc[transportCheck, "Response_Status"] = "ONSC"
+
+    # First Arrived Esri
+    df.loc[transportCheck, "FirstArrivedEsri"] = "-"
+    df.loc[ourOnlyUnit, "FirstArrivedEsri"] = "1"
+    return df
+
+
 def get_data_source(df):
     if "FirstArrived" in df:
         return "fire"
@@ -357,6 +463,7 @@ def get_data_source(df):
 # ##############################################################################################################################################
 
 
+@timer.profiler.profiled("analyzeFire")
 def analyzeFire(fileDF):
     """
     Extrapolates information from a specifically formatted XLS file, returning a larger set presumed, formatted, and corracted data
@@ -374,6 +481,7 @@ def analyzeFire(fileDF):
 
     # Correct no GPS coord issues
     # =================================================================
+    stage = timer.profiler.start("analyzeFire: geocode", fileDF)
     geocode.fixCoords(fileDF)
 
     dataSource = get_data_source(fileDF)
@@ -385,6 +493,7 @@ def analyzeFire(fileDF):
     #     lambda x: "".join(c for c in str(x["Master Incident Number"]) if c.isdigit()),
     #     axis=1,
     # )
+    stage = stage.next("analyzeFire: response status and first arrived", fileDF)
     # =================================================================
     #    Add Response Status Information
     # =================================================================
@@ -465,6 +574,7 @@ def analyzeFire(fileDF):
 
     #     Fire Data Error Checking
     # =================================================================
+    stage = stage.next("analyzeFire: validate", fileDF)
     from validateData import checkFile
     fileDF = checkFile(fileDF)
 
@@ -474,151 +584,16 @@ def analyzeFire(fileDF):
 
     #     Calculate Concurrent Use for Each Unit
     # =================================================================
+    stage = stage.next("analyzeFire: concurrent use", fileDF)
     fileDF = cu.addConcurrentUse(fileDF, "Unit Time Assigned", "Unit Time Call Cleared")
 
-    #     Set District 17 Values
+    #     Set ESD17, ETJ, COP, Response Area, and pop density Values
     # =================================================================
+    stage = stage.next("analyzeFire: boundaries", fileDF)
+    print("Adding Boundary Data:")
+    fileDF = boundaries.addBoundaryData(fileDF)
 
-    # Set up boundaries for ESD17
-    ##############################################################
-    print("loading esd shape:")
-    # esd17 = gpd.read_file("Shape\\esd17.shp")
-    shape_file_path = path.join(base_dir, "Shape", "esd17.shp")
-    esd17 = gpd.read_file(shape_file_path)
-    # specify that source data is 'NAD 1983 StatePlane Texas Central FIPS 4203 (US Feet)' - https://epsg.io/2277
-    esd17.set_crs(epsg=2277, inplace=True)
-    # and convert to 'World Geodetic System 1984' (used in GPS) - https://epsg.io/4326
-    esd17 = esd17.to_crs(4326)
-
-    # Assign values for esd17
-    ##############################################################
-    print("assigning ESD17 status:")
-
-    def isESD(jur, lon, lat, inc):
-        try:
-            if jur not in ["ESD02", "PFLUGERVILLE - ESD TSCO"]:
-                # print(lat, lon, "is not in esd17")
-                return False
-            plot = Point(lon, lat)
-            if (esd17.contains(plot)).any():
-                # print(lat, lon, "is in esd17")
-                return True
-            # print(lat, lon, "is not in esd17")
-            return False
-        except Exception as err:
-            print(err)
-            faults.append(inc)
-            pass
-
-    faults = []
-    fileDF["IsESD17"] = np.vectorize(isESD)(
-        fileDF["Jurisdiction"],
-        fileDF["X-Long"],
-        fileDF["Y_Lat"],
-        fileDF["Master Incident Number"],
-    )
-    if len(faults) > 0:
-        print(faults, end="\n")
-        exit(0)
-
-    # Clear data
-    esd17 = None
-
-    # =================================================================
-    #     Set District ETJ Values
-    # =================================================================
-
-    # Set up boundaries for ETJ
-    ##############################################################
-    print("loading esd shape:")
-    # etj = gpd.read_file("Shape\\ETJ.shp")
-    shape_file_path = path.join(base_dir, "Shape", "ETJ.shp")
-    etj = gpd.read_file(shape_file_path)
-    # specify that source data is 'NAD 1983 StatePlane Texas Central FIPS 4203 (US Feet)' - https://epsg.io/2277
-    etj.set_crs(epsg=2277, inplace=True)
-    # and convert to 'World Geodetic System 1984' (used in GPS) - https://epsg.io/4326
-    etj = etj.to_crs(4326)
-
-    # Assign values for etj
-    ##############################################################
-    print("assigning ETJ status:")
-
-    def isETJ(lon, lat):
-        plot = Point(lon, lat)
-        if (etj.contains(plot)).any():
-            return True
-        return False
-
-    fileDF["isETJ"] = np.vectorize(isETJ)(fileDF["X-Long"], fileDF["Y_Lat"])
-
-    # Clear data
-    etj = None
-
-    # =================================================================
-    #     Set District COP Values
-    # =================================================================
-    # Set up boundaries for cop
-    ##############################################################
-    print("loading COP shape:")
-    # cop = gpd.read_file("Shape\\City_Limits.shp")
-    shape_file_path = path.join(base_dir, "Shape", "City_Limits.shp")
-    cop = gpd.read_file(shape_file_path)
-    # specify that source data is 'NAD 1983 StatePlane Texas Central FIPS 4203 (US Feet)' - https://epsg.io/2277
-    cop.set_crs(epsg=2277, inplace=True)
-    # and convert to 'World Geodetic System 1984' (used in GPS) - https://epsg.io/4326
-    cop = cop.to_crs(4326)
-
-    # Assign values for cop
-    ##############################################################
-    print("assigning cop status:")
-
-    def isCOP(lon, lat):
-        plot = Point(lon, lat)
-        if (cop.contains(plot)).any():
-            return True
-        return False
-
-    fileDF["isCOP"] = np.vectorize(isCOP)(fileDF["X-Long"], fileDF["Y_Lat"])
-
-    # Clear data
-    cop = None
-
-    # =================================================================
-    #     Add Fire Response Areas to EMS Data
-    # =================================================================
-    print("loading response areas:")
-    # AFD Response Areas shape file
-    shape_file_path = path.join(base_dir, "Shape", "AFD_Response_Areas.shp")
-    responseArea = gpd.read_file(shape_file_path)
-    # specify that source data is 'NAD 1983 StatePlane Texas Central FIPS 4203 (US Feet)' - https://epsg.io/2277
-    responseArea.set_crs(epsg=2277, inplace=True)
-    # and convert to 'World Geodetic System 1984' (used in GPS) - https://epsg.io/4326
-    responseArea = responseArea.to_crs(4326)
-
-    def getResponseArea(lon, lat):
-        plot = Point(lon, lat)
-        try:
-            mapInd = (responseArea.index[responseArea.contains(plot)])[0]
-            return responseArea.loc[mapInd, "RESPONSE_A"]
-        except:
-            return None
-
-    if "AFD Response Box" not in fileDF:
-        fileDF["AFD Response Box"] = fileDF.apply(
-            lambda x: getResponseArea(x["X-Long"], x["Y_Lat"]),
-            axis=1,
-        )
-    # Clear data
-    responseArea = None
-
-    # =================================================================
-    #     Set pop density values Values
-    # =================================================================
-    import popden
-
-    fileDF = popden.addPopDen(fileDF)
-    # (getMapscoGrid)(fireDF["X-Long"], fireDF["Y_Lat"])
-
+    stage = stage.next("analyzeFire: status", fileDF)
     print("Adding Status:")
     # =================================================================
     #     Set Status for each call
@@ -639,26 +614,9 @@ def analyzeFire(fileDF):
     # ||  "firstArrivedEsri" == "Yes"
     # X - all other rows in a set of identical 'Master Incident Number' with no 'Unit Time Arrived At Scene'
 
-    # Set Canceled, 1(first arrived), or 0(multi incident)
-    conditions = [
-        (fileDF["Master Incident Number"] != fileDF.shift(1)["Master Incident Number"])
-        & (fileDF["Unit Time Arrived At Scene"].isnull()),
-        (fileDF["Master Incident Number"] == fileDF.shift(1)["Master Incident Number"]),
-    ]
-    choices = ["C", "0"]
-    fileDF["Status"] = np.select(conditions, choices, default="1")
-
-    # Overwrite 0 with X on canceled calls
-    # get array of indexes with 0
-    res0 = fileDF.index[fileDF["Status"] == "0"].tolist()
-
-    # this is going to be really slow...
-    # this will also break if referencing an incident removed by
-    for i in res0:
-        fileDF.loc[i, "Status"] = (
-            "X" if ((fileDF.loc[i - 1, "Status"] in (["X", "C"]))) else "0"
-        )
+    fileDF = addStatus(fileDF)
 
+    stage = stage.next("analyzeFire: shift", fileDF)
     # =================================================================
     #     Recalculate Shift Data
     # =================================================================
@@ -681,11 +639,13 @@ def analyzeFire(fileDF):
         lambda row: getShift(row[col_bb], row[col_w]), axis=1
     )
 
+    stage = stage.next("analyzeFire: stations", fileDF)
     # =================================================================
     #     Add a new Stations (Origin) Column
     # =================================================================
     fileDF = getStations(fileDF, dataSource, ourNames, stationDict, locations, reserveUnits, specialUnits)
 
+    stage = stage.next("analyzeFire: location at assign", fileDF)
     # =================================================================
     #     Add a new Column for if Unit was at its Station Address when Assigned
     # =================================================================
@@ -694,18 +654,21 @@ def analyzeFire(fileDF):
     # =================================================================
     #     Calculate Station Distances
     # =================================================================
+    stage = stage.next("analyzeFire: road distances", fileDF)
     print(" -- adding road checks")
     fileDF = rd.addRoadDistances(fileDF)
 
     # =================================================================
     #     add Is Sent From Closest Station
     # =================================================================
+    stage = stage.next("analyzeFire: closest station", fileDF)
     print(" -- adding Closest Station")
     fileDF = addIsClosestStation(fileDF)
 
     # =================================================================
     # Time delta/interval Colulmn Creation
     # =================================================================
+    stage = stage.next("analyzeFire: time deltas", fileDF)
     print(" -- adding Time Deltas")
     incidentCols = {
         "Earliest Time Phone Pickup to In Queue": [
@@ -747,10 +710,7 @@ def analyzeFire(fileDF):
     }
 
     # Create TimeDelta Columns
-    for col in incidentCols:
-        fileDF = utils.addTimeDiff(
-            fileDF, col, incidentCols[col][0], incidentCols[col][1]
-        )
+    fileDF, incidentTimeErrors = utils.addTimeDiffs(fileDF, incidentCols)
 
     # Move TimeDelta Columns to correct spot in file
     fileDF = utils.putColAfter(
@@ -800,8 +760,10 @@ def analyzeFire(fileDF):
         ]
 
     # Create TimeDelta Columns
-    for col in unitCols:
-        fileDF = utils.addTimeDiff(fileDF, col, unitCols[col][0], unitCols[col][1])
+    fileDF, unitTimeErrors = utils.addTimeDiffs(fileDF, unitCols)
+    timeErrors = pd.concat([incidentTimeErrors, unitTimeErrors]).drop_duplicates()
+    if len(timeErrors) > 0:
+        print(f"Unparseable times, left out of time deltas:\n{timeErrors.to_string(index=False)}")
 
     # Move TimeDelta Columns to correct spot in file
     fileDF = utils.putColAfter(
@@ -810,6 +772,7 @@ def analyzeFire(fileDF):
         "Unit Time Call Cleared",
     )
 
+    stage = stage.next("analyzeFire: staged as arrived", fileDF)
     # =================================================================
     # Correction of time: staging calls
     # =================================================================
@@ -818,14 +781,6 @@ def analyzeFire(fileDF):
     fileDF["INC_Staged_As_Arrived"] = 0
     fileDF["UNIT_Staged_As_Arrived"] = 0
 
-    def getSingleTimeDiff(df, row, t1, t2, reverse):
-        if not reverse:
-            res = df.loc[row, t2] - df.loc[row, t1]
-        else:
-            res = df.loc[row, t1] - df.loc[row, t2]
-        # Convert to seconds
-        return res / np.timedelta64(1, "s")
-
     #   ----------------
     #           Incident Recalculations
     #   ----------------
@@ -874,14 +829,9 @@ def analyzeFire(fileDF):
                 & (pd.to_datetime(recalc[u]) > pd.to_datetime(recalc[t]))
             )
         ]
-        recalcArray = recalc2.index.tolist()
-
-        for i in recalcArray:
-            fileDF.loc[i, "INC_Staged_As_Arrived"] = 1
-            for col in recalcIncidentCols:
-                fileDF.loc[i, col] = getSingleTimeDiff(
-                    fileDF, i, recalcIncidentCols[col][0], u, recalcIncidentCols[col][1]
-                )
+        recalcFromStaged(
+            fileDF, recalc2.index, "INC_Staged_As_Arrived", recalcIncidentCols, u
+        )
 
     # for col in recalcIncidentCols:
     #     fireDF = utils.putColAfter(fireDF, [col + "recalc"], col)
@@ -920,15 +870,11 @@ def analyzeFire(fileDF):
     ]
     if not recalc.empty:
         recalc2 = recalc[((recalc[u] < recalc[v]) & (recalc[u] > recalc[t]))]
-        recalcArray = recalc2.index.tolist()
-
-        for i in recalcArray:
-            fileDF.loc[i, "UNIT_Staged_As_Arrived"] = 1
-            for col in recalcUnitCols:
-                fileDF.loc[i, col] = getSingleTimeDiff(
-                    fileDF, i, recalcUnitCols[col][0], u, recalcUnitCols[col][1]
-                )
+        recalcFromStaged(
+            fileDF, recalc2.index, "UNIT_Staged_As_Arrived", recalcUnitCols, u
+        )
 
+    stage = stage.next("analyzeFire: time breakdowns", fileDF)
     # =================================================================
     #   Extra Time Formatted Columns
     # =================================================================
@@ -952,43 +898,15 @@ def analyzeFire(fileDF):
     # =================================================================
     #     get Complete Response Force for each Structure Fire
     # =================================================================
+    stage = stage.next("analyzeFire: transport check", fileDF)
     # check transport not reflecting onscene status
 
     if dataSource == "ems":
-        # Create a new list of all incidents where unit time arrived and scene or transport count are null
-        transportCheck = fileDF[
-            (pd.isnull(fileDF["Unit Time Arrived At Scene"]))
-            & (fileDF["Transport_Count"] > 0)
-        ].index.tolist()
-
-        # Iterate through said list...
-        for i in transportCheck:
-            # Set Status...
-            if (fileDF.loc[i, "Incident Call Count"] == 1) and fileDF.loc[
-                i, "Department"
-            ] in ourNames:
-                fileDF.loc[i, "Status"] = "1"
-            else:
-                fileDF.loc[i, "Status"] = "0"
-
-            # Response Status
-            fileDF.loc[i, "Response_Status"] = "ONSC"
-
-            # First Arrived Esri
-            if (fileDF.loc[i, "Incident Call Count"] == 1) and fileDF.loc[
-                i, "Department"
-            ] in ourNames:
-                fileDF.loc[i, "FirstArrivedEsri"] = "1"
-            else:
-                fileDF.loc[i, "FirstArrivedEsri"] = "-"
-            # fireDF.loc[i, "UNIT_Staged_As_Arrived"] = 1
-            # for col in recalcUnitCols:
-            #     fireDF.loc[i, col] = getSingleTimeDiff(
-            #         fireDF, i, recalcUnitCols[col][0], u, recalcUnitCols[col][1]
-            #     )
+        fileDF = fixTransportStatus(fileDF, ourNames)
     # =================================================================
     #     get Complete Response Force for each Structure Fire
     # =================================================================
+    stage = stage.next("analyzeFire: complete response force", fileDF)
     crfdf = getCRF(fileDF)
 
     # fireDF.join(crfdf.set_index("incident"), on="Master Incident Number")
@@ -999,6 +917,7 @@ def analyzeFire(fileDF):
         fileDF["Force_At_ERF_Time_of_Close"] = None
         print("No ERF Found")
 
+    stage = stage.next("analyzeFire: naming and column order", fileDF)
     # =================================================================
     # finalize naming
     # =================================================================
@@ -1017,6 +936,7 @@ def analyzeFire(fileDF):
 
     # export_to_xlsx("output", fileDF)
 
+    stage.end(fileDF)
     return fileDF
 
 
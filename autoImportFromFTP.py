@@ -1,13 +1,63 @@
 import ServerFiles as sf
 logger = sf.setup_logging('AutoImport.log')
 import gui  # assuming gui.py is in the same directory and its functions are refactored to be used here
+import rawFiles
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import freeze_support
 
+# files ingested at the same time, each in its own process.  1 keeps the original one-at-a-time path.
+# a rule in emailMonitoring.json can set its own with "workers" (see the README)
+max_workers = 1
 
-def process_files(directory, file_types, move_on_success, move_on_failure):
+
+def init_worker():
+    """Runs in each worker process before its first file"""
+    # workers must not prune the shared raw cache while another is writing to it, the parent prunes once they finish
+    rawFiles.autoPrune = False
+
+
+def ingest_file(file_path):
+    """Read, insert raw, preprocess, analyze, and insert a single file, independent of gui.fileArray, so it can run in a worker process"""
+    df, filetype = gui.readRaw(file_path)
+    # TEMP: FIX THIS IN SCHEMAS - remove latitude and longitude for fire
+    if filetype == "fire":
+        df = df.drop(["Longitude_At_Assign_Time", "Latitude_At_Assign_Time"], axis=1, errors="ignore")
+    gui.dumpRawData(df, filetype)
+    del df
+
+    fileDF = gui.af.analyzeFire(gui.pp.preprocess(rawFiles.readExcel(file_path)))
+    data_source = fileDF.loc[0, "Data_Source"]
+    gui.db.new_insert_DF(fileDF, data_source, bulk=True)
+    return len(fileDF)
+
+
+def process_files_parallel(files, move_on_success, move_on_failure, workers):
+    """Ingest files in a pool of worker processes, moving each one as soon as it succeeds or fails"""
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        futures = {pool.submit(ingest_file, file_path): file_path for file_path in files}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                rows = future.result()
+                sf.move_file(file_path, move_on_success)
+                print(f"Completed file: {file_path} ({rows} rows)")
+            except Exception as e:
+                print(f"Error processing {file_path}: {e}\n{traceback.format_exc()}")
+                sf.move_file(file_path, move_on_failure)
+    rawFiles.pruneCache()
+
+
+def process_files(directory, file_types, move_on_success, move_on_failure, workers=None):
     """Process files and move them based on the outcome."""
     files = list(sf.find_files_in_directory(directory, file_types))
     print(f"Files Found:{list(files)}")
 
+    workers = min(max_workers if workers is None else workers, len(files))
+    if workers > 1:
+        process_files_parallel(sorted(files), move_on_success, move_on_failure, workers)
+        return
+
     for file_path in files:
         print(f"Beginning Processing for file: {file_path}")
         print(gui.fileArray)
@@ -33,13 +83,14 @@ def main():
         file_types = rule.get("attachment_type")
         move_on_success = rule.get("move_on_success")
         move_on_failure = rule.get("move_on_failure")
+        workers = rule.get("workers")
 
         print(
             f"\n\n===========================================\nBeginning Processing for Directory : {directory}\n===========================================\n\n"
         )
 
         # Process files and move them based on the outcome
-        process_files(directory, file_types, move_on_success, move_on_failure)
+        process_files(directory, file_types, move_on_success, move_on_failure, workers)
 
     # # Update Dependency Tables
     gui.update_dependency_tables()
@@ -50,4 +101,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # worker processes of a frozen executable must run their task, not main()
+    freeze_support()
     main()
@@ -0,0 +1,200 @@
+import os
+import geopandas as gpd
+import ServerFiles as sf
+from os import path
+
+logger = sf.setup_logging("boundaries.log")
+# Setup base directory
+base_dir = sf.get_base_dir()
+
+# pre-projected copies of each shapefile, rebuilt whenever the .shp or .dbf is newer
+layerCacheDir = path.join(base_dir, "data", "shapes")
+
+# every layer loaded during this process: {(name, crs): (source modified times, GeoDataFrame)}
+loadedLayers = {}
+
+
+def getSourceTimes(name):
+    """returns the modified times of a layer's .shp and .dbf files, used to tell when cached copies are stale"""
+    times = []
+    for ext in ["shp", "dbf"]:
+        sourcePath = path.join(base_dir, "Shape", f"{name}.{ext}")
+        times.append(path.getmtime(sourcePath) if path.exists(sourcePath) else None)
+    return tuple(times)
+
+
+def readShape(name, crs=None):
+    """
+    Read a boundary shapefile from the Shape folder, and convert it to 'World Geodetic System 1984' (used in GPS) - https://epsg.io/4326
+    """
+    layer = gpd.read_file(path.join(base_dir, "Shape", f"{name}.shp"))
+    if crs is not None:
+        layer.set_crs(epsg=crs, inplace=True)
+        if crs != 4326:
+            layer = layer.to_crs(4326)
+    elif layer.crs is None:
+        layer.set_crs(epsg=4326, inplace=True)
+    return layer
+
+
+def loadShape(name, crs=None):
+    """
+    Load a boundary layer from the Shape folder, in 'World Geodetic System 1984' (used in GPS) - https://epsg.io/4326
+
+    Each layer is read and projected once per process, and a projected GeoParquet copy is kept in data/shapes,
+    so later processes can skip the projection entirely.  Both are replaced when the .shp or .dbf is modified.
+    The returned GeoDataFrame (with its spatial index already built) is shared by every caller, so do not modify it.
+
+    Parameters
+    --------------------------------
+    name : str
+        file name in the Shape folder, without the .shp extension
+    crs : int (optional)
+        epsg code the source data is stored in.  When not given, the file's own crs is trusted, falling back to 4326.
+
+    Returns
+    --------------------------------
+    GeoDataFrame
+    """
+    key = (name, crs)
+    sourceTimes = getSourceTimes(name)
+    if key in loadedLayers and loadedLayers[key][0] == sourceTimes:
+        return loadedLayers[key][1]
+
+    cachePath = path.join(layerCacheDir, f"{name}_{crs if crs is not None else 'native'}.parquet")
+    layer = None
+    if path.exists(cachePath) and all(
+        t is None or path.getmtime(cachePath) > t for t in sourceTimes
+    ):
+        try:
+            layer = gpd.read_parquet(cachePath)
+        except Exception as e:
+            logger.warning(f"Could not read cached layer {cachePath}: {e}")
+
+    if layer is None:
+        print(f"loading {name} shape:")
+        layer = readShape(name, crs)
+        try:
+            os.makedirs(layerCacheDir, exist_ok=True)
+            layer.to_parquet(cachePath)
+        except Exception as e:
+            logger.warning(f"Could not write cached layer {cachePath}: {e}")
+
+    # build the spatial index now, so every later join can share it
+    layer.sindex
+    loadedLayers[key] = (sourceTimes, layer)
+    return layer
+
+
+def getPoints(df):
+    """
+    Convert the incident coordinates of a dataframe to points, once, for every boundary lookup
+
+    Parameters
+    --------------------------------
+    df : Dataframe
+        containing "X-Long" and "Y_Lat" columns
+
+    Returns
+    --------------------------------
+    GeoDataFrame
+        a geometry only frame sharing the index of df
+    """
+    return gpd.GeoDataFrame(
+        index=df.index,
+        geometry=gpd.points_from_xy(df["X-Long"], df["Y_Lat"]),
+        crs=4326,
+    )
+
+
+def getContainingIndex(points, layer):
+    """
+    Find the first polygon of a layer containing each point, using the layer's spatial index
+
+    Parameters
+    --------------------------------
+    points : GeoDataFrame
+        points, as made by getPoints
+    layer : GeoDataFrame
+        polygons, in the same crs as the points
+
+    Returns
+    --------------------------------
+    Series
+        position in the layer of the first containing polygon for each point, or NaN where no polygon contains it.
+        Indexed like points.
+    """
+    # joined on positions, so a repeated index label in either frame can't merge two rows' matches together
+    joined = gpd.sjoin(
+        points[["geometry"]].reset_index(drop=True),
+        layer[["geometry"]].reset_index(drop=True),
+        how="inner",
+        predicate="within",
+    )
+    first = joined.groupby(level=0)["index_right"].min().reindex(range(len(points)))
+    return first.set_axis(points.index)
+
+
+def isContained(points, layer):
+    """returns a boolean Series, True where a point falls inside any polygon of the layer"""
+    return getContainingIndex(points, layer).notnull()
+
+
+def getContainingValue(points, layer, column):
+    """returns the value of column for the first polygon containing each point, or None where no polygon contains it"""
+    values = getContainingIndex(points, layer).map(layer[column].reset_index(drop=True))
+    return values.astype(object).where(values.notnull(), None)
+
+
+def addBoundaryData(fileDF):
+    """
+    Add every polygon based column (ESD17, ETJ, COP, AFD Response Box, and population data) to a dataset in bulk
+
+    Parameters
+    --------------------------------
+    fileDF : Dataframe
+        containing "X-Long", "Y_Lat", and "Jurisdiction" columns
+
+    Returns
+    --------------------------------
+    Dataframe
+    """
+    points = getPoints(fileDF)
+
+    # specify that source data is 'NAD 1983 StatePlane Texas Central FIPS 4203 (US Feet)' - https://epsg.io/2277
+
+    #     Set District 17 Values
+    # =================================================================
+    print("assigning ESD17 status:")
+    esd17 = loadShape("esd17", crs=2277)
+    fileDF["IsESD17"] = (
+        fileDF["Jurisdiction"].isin(["ESD02", "PFLUGERVILLE - ESD TSCO"])
+        & isContained(points, esd17).to_numpy()
+    ).to_numpy()
+
+    #     Set District ETJ Values
+    # =================================================================
+    print("assigning ETJ status:")
+    etj = loadShape("ETJ", crs=2277)
+    fileDF["isETJ"] = isContained(points, etj).to_numpy()
+
+    #     Set District COP Values
+    # =================================================================
+    print("assigning cop status:")
+    cop = loadShape("City_Limits", crs=2277)
+    fileDF["isCOP"] = isContained(points, cop).to_numpy()
+
+    #     Add Fire Response Areas to EMS Data
+    # =================================================================
+    if "AFD Response Box" not in fileDF:
+        print("assigning response areas:")
+        responseArea = loadShape("AFD_Response_Areas", crs=2277)
+        fileDF["AFD Response Box"] = getContainingValue(points, responseArea, "RESPONSE_A")
+
+    #     Set pop density values Values
+    # =================================================================
+    import popden
+
+    fileDF = popden.addPopDen(fileDF, points)
+
+    return fileDF
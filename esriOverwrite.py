@@ -1,10 +1,13 @@
 import time
+import gzip
+import numpy as np
 from arcgis import GIS
 from dotenv import load_dotenv
 from os import getenv, remove, path
 import datetime
 from ServerFiles import setup_logging, get_base_dir
 import logging
+import pandas as pd
 
 logName = f"Esri_Export-{(datetime.datetime.now()).strftime('%y-%m-%d_%H-%M')}.log"
 logger = setup_logging(logName)
@@ -15,7 +18,65 @@ arc_gis_csv_id = "620a5cd3ccdd4b39908158b3cb87e3b5"
 
 temp_CSV_file = path.join(base_dir, "EMSFireRunData.csv")
 
-esri_Export_Query = "SELECT * FROM [dbo].[v_esri_export-Query-Filtered] where [Phone_Pickup_Time] >= '01/01/2020'"
+# compression for the exported csv: None or "gzip".  ArcGIS CSV items must be uploaded uncompressed,
+# so only use gzip with a publisher that accepts it.
+esri_CSV_compression = None
+
+# ordered so the repeat assignments of a unit to an incident always come back in the same order,
+# and keep the same occurrence in their feature keys (see getFeatureKeys)
+esri_Export_Query = (
+    "SELECT * FROM [dbo].[v_esri_export-Query-Filtered] where [Phone_Pickup_Time] >= '01/01/2020'"
+    " ORDER BY [Incident_Number], [Unit], [Unit_Assigned]"
+)
+
+# rows pulled from the database at a time while exporting
+esri_chunk_size = 50000
+
+# "delta" sends only added, changed and removed rows to the feature layer.  "csv" republishes the whole export.
+esri_publish_mode = "delta"
+
+# what was last published to the feature layer: a Row_Hash and OBJECTID for each row key
+esri_published_state = path.join(base_dir, "data", "esri_published.parquet")
+
+# the hosted feature layer published from the csv item.  When None, it is found from the csv item.
+arc_gis_layer_id = None
+
+# the columns identifying a row of the export
+esri_key_columns = ["Incident_Number", "Unit"]
+
+# features sent per edit_features call
+esri_edit_batch_size = 1000
+
+# low-cardinality text columns, held as categoricals while streaming
+esri_categories = [
+    "Data_Source",
+    "Status",
+    "Unit",
+    "Unit_Disposition",
+    "Incident_Type",
+    "City",
+    "Problem",
+    "Jurisdiction",
+    "Response_Plan",
+    "Priority_Description",
+    "Population_Classification",
+    "Station",
+    "Response_Status",
+    "Department",
+    "Frontline_Status",
+]
+
+# BIT auto converted to BOOLEAN, but exists in ESRI as INTEGER
+esri_int_columns = [
+    "IsESD17",
+    "isETJ",
+    "isCOP",
+    "INC_Staged_As_Arrived",
+    "UNIT_Staged_As_Arrived",
+]
+
+# read as nullable integers, so a NULL BIT or integer stays null instead of failing the conversion
+esri_dtypes = {col: "Int64" for col in esri_int_columns + ["Unit_Usage_At_Time_of_Alarm"]}
 
 EsriTableArray = [
     "Incident_Number",
@@ -86,15 +147,27 @@ def getFormattedTable():
 
         # BIT auto converted to BOOLEAN, but exists in ESRI as INTEGER
         logger.info("Converting boolean to INTS for ESRI")
-        for col in [
-            "IsESD17",
-            "isETJ",
-            "isCOP",
-            "INC_Staged_As_Arrived",
-            "UNIT_Staged_As_Arrived",
-        ]:
-            df[col] = df[col].astype(int)
-        return df
+        return df.astype(esri_dtypes)
+    except Exception as e:
+        logger.info("  - Process Failed!  - Error in Database Extraction - Please check the logs.")
+        logging.exception("Exception found in Database Extraction")
+        exit(1)
+
+def getFormattedChunks(db=None):
+    """Streaming version of getFormattedTable: yields the export a chunk at a time, so the whole history is never in memory at once"""
+    from Database import SQLDatabase
+
+    try:
+        if db is None:
+            db = SQLDatabase()
+        for df in db.retrieve_chunks(
+            esri_Export_Query,
+            ["Phone_Pickup_Time"],
+            chunksize=esri_chunk_size,
+            dtypes=esri_dtypes,
+            categories=esri_categories,
+        ):
+            yield df
     except Exception as e:
         logger.info("  - Process Failed!  - Error in Database Extraction - Please check the logs.")
         logging.exception("Exception found in Database Extraction")
@@ -116,34 +189,301 @@ class EsriDatabase:
         self.gis = GIS(your_org_url, username, password)
 
     def empty(self):
+        # the layer no longer matches the published state: the next syncDelta starts over
+        clearPublishedState()
         self.tbl.manager.truncate()  # truncate table
 
     def appendDF(self, df):
+        clearPublishedState()
         adds = df.spatial.to_featureset()
         self.tbl.edit_features(adds=adds)
 
     def overwriteDF(self, df):
         self.empty()
         self.appendDF(df)
+
+    def publishCSV(self, publisher=None):
+        """
+        Stream the export to a temporary CSV, and hand it to a publisher.
+
+        publisher : object with a publish(csv_path) method (optional)
+            defaults to the ArcGIS CSV item and feature layer.  Substitute a local fake to test without ArcGIS.
+        """
+        if publisher is None:
+            publisher = ArcGISPublisher(self.gis, arc_gis_csv_id)
+
+        csv_path = temp_CSV_file + (".gz" if esri_CSV_compression == "gzip" else "")
+        logger.info("Writing Temporary CSV file...")
+        writeExportCSV(getFormattedChunks(), csv_path, esri_CSV_compression)
+
+        # publishing with overwrite gives every feature a new OBJECTID, so the published state is dropped first
+        # (even if the publish then fails part way), and the next syncDelta replaces the whole layer
+        clearPublishedState()
+        publisher.publish(csv_path)
+
+        logger.info("Removing Temporary CSV file.")
+        remove_with_retry(csv_path)
+
+    def getFeatureLayer(self):
+        """the hosted feature layer the csv item is published to"""
+        if arc_gis_layer_id is not None:
+            return self.gis.content.get(arc_gis_layer_id).layers[0]
+        csv_item = self.gis.content.get(arc_gis_csv_id)
+        return csv_item.related_items("Service2Data", "forward")[0].layers[0]
+
+    def syncDelta(self, editor=None):
+        """
+        Send only what changed since the last publish to the feature layer: adds, updates, and deletes, in batches.
+
+        The Row_Hash and OBJECTID of every published row are kept in esri_published_state.  Without it
+        (the first run, or after it is deleted) the layer is truncated and everything is added once.
+
+        editor : object with truncate() and edit(adds, updates, deletes) methods (optional)
+            defaults to the ArcGIS feature layer.  Substitute a local mock to test without ArcGIS.
+        """
+        from Database import SQLDatabase
+
+        if editor is None:
+            editor = FeatureLayerEditor(self.getFeatureLayer())
+
+        state = loadPublishedState()
+        if state is None:
+            logger.info("No published state found - replacing the whole feature layer")
+            editor.truncate()
+            state = pd.DataFrame(columns=["Row_Hash", "OBJECTID"])
+
+        db = SQLDatabase()
+        keyCounts = {}
+        seen = []
+        totals = {"adds": 0, "updates": 0, "deletes": 0}
+        for df in getFormattedChunks(db):
+            keys = getFeatureKeys(df, keyCounts)
+            hashes = db.row_hashes(df, esri_key_columns).to_numpy()
+            seen.append(keys)
+
+            published = keys.isin(state.index)
+            changed = published.copy()
+            changed[published] = state.loc[keys[published], "Row_Hash"].to_numpy() != hashes[published]
+
+            adds = df[~published]
+            updates = df[changed]
+            oids = state.loc[keys[changed], "OBJECTID"].tolist()
+            added, updated, _ = sendEdits(editor, adds, updates, oids, [])
+
+            # only remember edits ArcGIS accepted, so anything that failed is retried next run
+            newRows = pd.DataFrame(
+                {"Row_Hash": hashes[~published][added["success"]], "OBJECTID": added["objectIds"]},
+                index=keys[~published][added["success"]],
+            )
+            state.loc[keys[changed][updated], "Row_Hash"] = hashes[changed][updated]
+            state = pd.concat([state, newRows])
+            totals["adds"] += len(newRows)
+            totals["updates"] += int(updated.sum())
+            # saved as it goes, so a failure part way through never re-adds what was already sent
+            savePublishedState(state)
+
+        # rows no longer in the export
+        gone = state.index[~state.index.isin(pd.Index(np.concatenate(seen)) if seen else pd.Index([]))]
+        if len(gone) > 0:
+            _, _, deleted = sendEdits(editor, None, None, [], state.loc[gone, "OBJECTID"].tolist())
+            state = state.drop(gone[deleted])
+            totals["deletes"] = int(deleted.sum())
+
+        savePublishedState(state)
+        logger.info(
+            f"Feature Layer Successfully Updated - {totals['adds']} added, {totals['updates']} updated, {totals['deletes']} deleted"
+        )
+
+
+class FeatureLayerEditor:
+    """
+    Sends edits to an ArcGIS feature layer.
+    Anything with the same truncate() and edit() methods (a local mock, for testing) can be used instead.
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def truncate(self):
+        self.layer.manager.truncate()
+
+    def edit(self, adds, updates, deletes):
+        """apply one batch of edits, returning the edit_features result"""
+        return self.layer.edit_features(
+            adds=adds,
+            updates=updates,
+            deletes=",".join(str(oid) for oid in deletes),
+        )
+
+
+def getFeatureKeys(df, keyCounts):
+    """
+    Returns a unique key for each row of the export: Incident_Number|Unit|occurrence.
+    keyCounts carries the occurrences already seen between chunks, since a unit can be on an incident more than once.
+    The occurrences only stay the same from run to run because esri_Export_Query orders by Unit_Assigned.
+    """
+    base = df[esri_key_columns[0]].astype(str)
+    for col in esri_key_columns[1:]:
+        base = base + "|" + df[col].astype(str)
+    occurrence = base.groupby(base).cumcount() + base.map(keyCounts).fillna(0).astype(int)
+    for key, count in base.value_counts().items():
+        keyCounts[key] = keyCounts.get(key, 0) + count
+    return pd.Index(base + "|" + occurrence.astype(str))
+
+
+def toFeatures(df, objectIds=None):
+    """Convert export rows to ArcGIS features: datetimes as epoch milliseconds, nulls as None, and a point from X_Long/Y_Lat"""
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            ms = df[col].dt.as_unit("ms").astype("int64")
+            df[col] = ms.astype(object).where(df[col].notnull(), None)
+    records = df.astype(object).where(df.notnull(), None).to_dict("records")
+    features = []
+    for i, attributes in enumerate(records):
+        if objectIds is not None:
+            attributes["OBJECTID"] = objectIds[i]
+        features.append(
+            {
+                "attributes": attributes,
+                "geometry": {"x": attributes.get("X_Long"), "y": attributes.get("Y_Lat"), "spatialReference": {"wkid": 4326}},
+            }
+        )
+    return features
+
+
+def sendEdits(editor, adds, updates, updateIds, deleteIds):
+    """
+    Send adds, updates and deletes to the editor in batches of esri_edit_batch_size.
+
+    Returns
+    --------------------------------
+    dict, array, array
+        the adds that succeeded ({"success": mask, "objectIds": new OBJECTIDs}), and masks of the updates and deletes that succeeded
+    """
+    addSuccess, addIds, updateSuccess, deleteSuccess = [], [], [], []
+    jobs = [
+        ("adds", adds, None),
+        ("updates", updates, updateIds),
+    ]
+    for kind, df, ids in jobs:
+        if df is None:
+            continue
+        for start in range(0, len(df), esri_edit_batch_size):
+            batch = df.iloc[start : start + esri_edit_batch_size]
+            batchIds = None if ids is None else ids[start : start + esri_edit_batch_size]
+            features = toFeatures(batch, batchIds)
+            try:
+                if kind == "adds":
+                    results = editor.edit(features, [], [])["addResults"]
+                else:
+                    results = editor.edit([], features, [])["updateResults"]
+            except Exception as e:
+                logger.error(f"  - Failed to send {len(features)} {kind} to ESRI: {e}")
+                results = [{"success": False}] * len(features)
+            for result in results:
+                if kind == "adds":
+                    addSuccess.append(bool(result.get("success")))
+                    if result.get("success"):
+                        addIds.append(result.get("objectId"))
+                else:
+                    updateSuccess.append(bool(result.get("success")))
+
+    for start in range(0, len(deleteIds), esri_edit_batch_size):
+        batch = deleteIds[start : start + esri_edit_batch_size]
+        try:
+            results = editor.edit([], [], batch)["deleteResults"]
+        except Exception as e:
+            logger.error(f"  - Failed to send {len(batch)} deletes to ESRI: {e}")
+            results = [{"success": False}] * len(batch)
+        deleteSuccess += [bool(result.get("success")) for result in results]
+
+    return (
+        {"success": np.array(addSuccess, dtype=bool), "objectIds": addIds},
+        np.array(updateSuccess, dtype=bool),
+        np.array(deleteSuccess, dtype=bool),
+    )
+
+
+def loadPublishedState():
+    if not path.exists(esri_published_state):
+        return None
+    try:
+        return pd.read_parquet(esri_published_state)
+    except Exception as e:
+        logger.warning(f"Could not read published state {esri_published_state}: {e}")
+        return None
+
+
+def savePublishedState(state):
+    state["OBJECTID"] = state["OBJECTID"].astype("int64")
+    state.to_parquet(esri_published_state)
+
+
+def clearPublishedState():
+    """Forget the published state, for when the layer is replaced outside of syncDelta"""
+    if path.exists(esri_published_state):
+        logger.info("Removing the published state - the next delta sync replaces the whole feature layer")
+        remove(esri_published_state)
+
+
+def writeExportCSV(chunks, csv_path, compression=None):
+    """
+    Write an iterable of DataFrames to one CSV file as they arrive, so only a single chunk is ever held in memory.
+
+    Parameters
+    --------------------------------
+    chunks : iterable of DataFrame
+        the export, in order
+    csv_path : str
+        file to write
+    compression : str (optional)
+        None for plain text, or "gzip"
+
+    Returns
+    --------------------------------
+    dict
+        rows written, seconds taken, and the size of the file in bytes
+    """
+    start = time.perf_counter()
+    rows = 0
+    opener = gzip.open if compression == "gzip" else open
+    with opener(csv_path, "wt", newline="") as file:
+        for i, df in enumerate(chunks):
+            # the header only once, at the top
+            df.to_csv(file, index=False, header=(i == 0))
+            rows += len(df)
+
+    seconds = time.perf_counter() - start
+    size = path.getsize(csv_path)
+    logger.info(
+        f"  - Wrote {rows} rows in {seconds:0.1f} seconds ({rows / max(seconds, 1e-9):0.0f} rows/sec), {size / 2**20:0.1f} MB"
+    )
+    return {"rows": rows, "seconds": seconds, "bytes": size}
+
+
+class ArcGISPublisher:
+    """
+    Publishes an export CSV to ArcGIS online.
+    A publisher only needs a publish(csv_path) method, so anything with one (a local fake, for testing) can be used instead.
+    """
+
+    def __init__(self, gis, item_id):
+        self.gis = gis
+        self.item_id = item_id
+
     # ===============================================================================================================
     #  this is the data provided by ESRI
     #  It will upload a CSV file drectly to ARCGIS online
     #  and then PUBLISH the csv file to a new feature layer,
     #  overwriting the previous one and retaining dashboards created from it.
     # ===============================================================================================================
-    def publishCSV(self):
-        df = getFormattedTable()
-        logger.info("Writing Temporary CSV file...")
-
-        with open(temp_CSV_file, 'w', newline='') as file:
-            df.to_csv(file, index=False)
-            file.close
-
+    def publish(self, csv_path):
         logger.info("Sending to ESRI")
 
         try:
             logger.info("  - Finding Existing file")
-            csv_item = self.gis.content.get(arc_gis_csv_id)
+            csv_item = self.gis.content.get(self.item_id)
 
             item_props = {
                 "type": csv_item.type,
@@ -154,7 +494,7 @@ class EsriDatabase:
             }
         except Exception as e:
             logger.error("  - Process Failed!  - Could not get current item from ESRI")
-            remove(temp_CSV_file)
+            remove(csv_path)
             logging.exception("Exception from CSV File Upload")
             exit(1)
 
@@ -162,13 +502,13 @@ class EsriDatabase:
             logger.info("  - Pushing File to Esri")
             csv_item.update(
                 item_props,
-                data=temp_CSV_file,
+                data=csv_path,
             )
 
             logger.info("  - Complete!")
         except Exception as e:
             logger.error("  - Process Failed!  - Error uploading CSV file to ESRI. Removing Temporary CSV file")
-            remove(temp_CSV_file)
+            remove(csv_path)
             logging.exception("Exception from CSV File Upload")
             exit(1)
 
@@ -188,15 +528,12 @@ class EsriDatabase:
         except Exception as e:
             logger.error(f"  - Process Failed!  - Error Publishing CSV on ESRI Portal\n{e}")
             logging.exception("Exception in ESRI CSV Publishing")
-            remove_with_retry(temp_CSV_file)
+            remove_with_retry(csv_path)
             exit(1)
 
         logger.info("Feature Layer Successfully Updated - releasing Connection to ARCGIS")
         del csv_item
 
-        logger.info("Removing Temporary CSV file.")
-        remove_with_retry(temp_CSV_file)
-
 
 def remove_with_retry(file_path, retries=3, delay=1):
     """Attempt to remove a file, with retries if it is being used by another process."""
@@ -243,4 +580,7 @@ if __name__ == "__main__":
             exit(1)
     esriDF = EsriDatabase()
     esriDF.connect()
-    esriDF.publishCSV()
+    if esri_publish_mode == "delta":
+        esriDF.syncDelta()
+    else:
+        esriDF.publishCSV()
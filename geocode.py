@@ -1,8 +1,12 @@
 from requests import get as getRequest
 from dotenv import load_dotenv
-from time import time
-from os import getenv
+from time import time, monotonic, sleep
+from os import getenv, path
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
 import pandas as pd
+import ServerFiles as sf
 
 import logging
 
@@ -20,6 +24,141 @@ PARAMS = {
 }
 
 
+cachePath = path.join(sf.get_base_dir(), "data", "geocode.sqlite")
+cacheTTL = 90 * 24 * 60 * 60  # seconds before a cached address is looked up again
+rateLimit = 1  # requests per second allowed by the api
+workers = 4  # concurrent lookups for addresses missing from the cache
+tcesd2_admin_office_gps = "30.439196854214842, -97.6199526861625"
+
+
+def normalizeAddress(address):
+    """Return an address in a consistent form for cache keys, or None if there is no address"""
+    if address is None or pd.isnull(address):
+        return None
+    return " ".join(str(address).upper().split())
+
+
+class GeocodeCache:
+    """A persistent address -> coordinates lookup, stored in SQLite, which tracks hits and misses"""
+
+    def __init__(self, dbPath=None, ttl=None):
+        self.dbPath = dbPath or cachePath
+        self.ttl = cacheTTL if ttl is None else ttl
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(self.dbPath)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode (address TEXT PRIMARY KEY, coords TEXT NOT NULL, fetched REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, address):
+        """Return cached coordinates for an address, or None if missing or older than the ttl"""
+        row = self.conn.execute(
+            "SELECT coords, fetched FROM geocode WHERE address = ?",
+            (normalizeAddress(address),),
+        ).fetchone()
+        if row is None or time() - row[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, address, coords):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO geocode (address, coords, fetched) VALUES (?, ?, ?)",
+            (normalizeAddress(address), coords, time()),
+        )
+        self.conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
+
+    def close(self):
+        self.conn.close()
+
+
+class RateLimiter:
+    """A token bucket, shared between threads, that sleeps until a request is allowed instead of spinning"""
+
+    def __init__(self, rate=None, capacity=1):
+        self.rate = rateLimit if rate is None else rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+limiter = RateLimiter()
+
+
+def geocodeAddresses(addresses, cache=None):
+    """Return a dict of address -> "lat,lng" for every passed address.
+    Cached addresses are free, and the rest are looked up concurrently, within the api rate limit.
+    ----------
+    addresses : iterable
+        addresses to find coordinates for.
+    cache : GeocodeCache (optional)
+        cache to read from and save to.  The default cache is opened (and closed) when not given.
+    """
+    ownCache = cache is None
+    if ownCache:
+        cache = GeocodeCache()
+
+    found = {}
+    # spellings of the same address share one cache entry and one lookup: {normalized: [addresses]}
+    missing = {}
+    for address in set(addresses):
+        key = normalizeAddress(address)
+        if key is None:
+            print(" - Geocoding Failed")
+            found[address] = tcesd2_admin_office_gps
+        elif key in missing:
+            missing[key].append(address)
+        else:
+            coords = cache.get(key)
+            if coords is None:
+                missing[key] = [address]
+            else:
+                found[address] = coords
+
+    if missing:
+        print(f"I'll have to look up {len(missing)} addresses")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            lookups = [spellings[0] for spellings in missing.values()]
+            results = pool.map(lookupCoordinates, lookups)
+            for (key, spellings), coords in zip(missing.items(), results):
+                if coords is None:
+                    print(f" - Geocoding Failed: {key}")
+                    coords = tcesd2_admin_office_gps
+                else:
+                    print(f"  {key}  -  {coords}")
+                    cache.put(key, coords)
+                for address in spellings:
+                    found[address] = coords
+
+    print(f"Geocode cache: {cache.stats()}")
+    if ownCache:
+        cache.close()
+    return found
+
+
 def addCoordinates(df, progress=None):
     """Return a passed dataframe with GPS coordinates added.
     ----------
@@ -29,52 +168,25 @@ def addCoordinates(df, progress=None):
 
     print("Beginning calls to Google:")
 
-    hashAddress = {}
-
-    def doesNeed(row, lon, lat, progress):
-        address = row["Address of Incident"]
-
-        # geocode as little as possible.  log addresses as they are searched
-        if address in hashAddress.keys():
-            print(f"{address} found in hash.")
-            return hashAddress[address]
-
-        # return lat and lon if they already exist
-        if not pd.isnull(lat) and not pd.isnull(lon):
-            if lat != 0 and lon != 0:
-                return f"{lat}, {lon}"
-
-        # get coords and return them
-        try:
-            print(f"I'll have to look up {address}")
-            coords = getCoordinates(address, progress)
-            print(f"  -  {coords}")
-            hashAddress[address] = coords
-        except Exception as e:
-            print(e)
-            return f"{lat}, {lon}"
-        return coords
-
-    df["GPS"] = df.apply(
-        lambda row: doesNeed(row, row["X-Long"], row["Y_Lat"], progress),
-        axis=1,
-    )
+    # geocode as little as possible: only rows without usable coordinates, once per address
+    lat = pd.to_numeric(df["Y_Lat"], errors="coerce")
+    lon = pd.to_numeric(df["X-Long"], errors="coerce")
+    needed = lat.isnull() | lon.isnull() | (lat == 0) | (lon == 0)
 
-    errors = {}
+    addresses = df.loc[needed, "Address of Incident"]
+    coords = geocodeAddresses(addresses.tolist())
+    gps = pd.Series([coords[address] for address in addresses], index=addresses.index, dtype=object)
 
-    def getCoord(row, pos):
-        gps = row["GPS"]
+    def getCoord(gps, pos):
         # print(f"processing {gps}")
         try:
             return float(gps.split(",")[pos])
         except Exception as e:
-            # errors[row["Sr No"]] = e
             print(e)
             return None
 
-    df["Y_Lat"] = df.apply(lambda row: getCoord(row, 0), axis=1)
-    df["X-Long"] = df.apply(lambda row: getCoord(row, 1), axis=1)
-    df = df.drop(["GPS"], axis=1)
+    df.loc[needed, "Y_Lat"] = gps.map(lambda x: getCoord(x, 0))
+    df.loc[needed, "X-Long"] = gps.map(lambda x: getCoord(x, 1))
 
     # print(errors)
     print("Complete")
@@ -82,32 +194,33 @@ def addCoordinates(df, progress=None):
     return df
 
 
+def lookupCoordinates(address):
+    """Return "lat,lng" for an address from the api, or None if it could not be found"""
+    print(f"\tObtaining GPS for: {address}")
+    # Rate Limiting requests, without tying up the thread while waiting
+    limiter.acquire()
+    params = dict(PARAMS, address=address)
+
+    try:
+        r = getRequest(url=URL, params=params, timeout=30)
+        loc = r.json()["results"][0]["geometry"]["location"]
+        return f'{loc["lat"]},{loc["lng"]}'
+    except Exception:
+        return None
+
+
 def getCoordinates(address, progress={}):
-    tcesd2_admin_office_gps = "30.439196854214842, -97.6199526861625"
     failure = tcesd2_admin_office_gps
     # throw an error if address is invalid
     if address is None:
         print(" - Geocoding Failed")
         return failure
     # progress["value"] += 1
-    print(f"\tObtaining GPS for: {address}")
-    # Rate Limiting requests
-    start, end = time(), time()
-    PARAMS["address"] = address
-
-    try:
-        r = getRequest(url=URL, params=PARAMS)
-        loc = r.json()["results"][0]["geometry"]["location"]
-
-        # get coordinate function must always take 1 second by rules of api
-        while end - start < 1:
-            end = time()
-
-        # return time()
-        return f'{loc["lat"]},{loc["lng"]}'
-    except:
+    coords = lookupCoordinates(address)
+    if coords is None:
         print(" - Geocoding Failed")
         return failure
+    return coords
 
 
 def fixCoords(df):
@@ -9,6 +9,7 @@ from tkinter.filedialog import askopenfile, askopenfilenames
 import analyzefire as af
 import preprocess as pp
 import numpy as np
+import rawFiles
 
 from Database import SQLDatabase
 
@@ -77,7 +78,7 @@ def guiAnalyze():
 
         db = SQLDatabase()
         # db.insertDF(fileDF)
-        db.new_insert_DF(fileDF, data_source)
+        db.new_insert_DF(fileDF, data_source, bulk=True)
 
     return None
 
@@ -104,7 +105,7 @@ def update_dependency_tables():
 def readRaw(filePath):
     excel_filename = r"{}".format(filePath)
     # read the file
-    df = pd.read_excel(excel_filename)
+    df = rawFiles.readExcel(excel_filename)
 
     if "Ph_PU_Time" in df.columns or "Ph PU Time" in df.columns:
         fileType = "ems" 
@@ -170,7 +171,7 @@ def addFiles(files=None):
             try:
                 excel_filename = r"{}".format(file)
                 # read the file
-                fileArray[file] = pp.preprocess(pd.read_excel(excel_filename))
+                fileArray[file] = pp.preprocess(rawFiles.readExcel(excel_filename))
 
             except ValueError:
                 messagebox.showerror("Invalid File", "The loaded file is invalid")
@@ -191,7 +192,7 @@ def addFiles(files=None):
 
 def dumpRawData(df, type):
     print("Dumping Raw Data to Database")
-    db.UpsertRaw(df, type)
+    db.UpsertRaw(df, type, bulk=True, skip_unchanged=True)
 
 
 def run():
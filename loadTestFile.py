@@ -1,6 +1,7 @@
 import pandas as pd
 from datetime import datetime as dt
 from preprocess import preprocess
+import rawFiles
 
 
 def get(requestingRaw=False):
@@ -25,7 +26,7 @@ def get(requestingRaw=False):
     # file = "XLSs\\06 June ESD02 EMS Data.xlsx"
     # file = "ESD02 Raw Data - Weekly-8.22.22.xlsx"
     file = "2012_2022 ESD02 Raw Data - AFD Fire.xlsx"
-    fireDF = pd.read_excel(file)
+    fireDF = rawFiles.readExcel(file)
 
     if requestingRaw:
         return fireDF
@@ -23,7 +23,6 @@ hidden_imports = [
     "email.mime.multipart",
     "email.mime.text",
     "email.mime.application",
-    "geopy.distance",
 ]
 
 executables_info = {
@@ -1,82 +1,45 @@
-from shapely.geometry import Point
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import ServerFiles as sf
-from os import path
+import boundaries
+
+def addPopDen(fireDF, points=None):
+    """
+    Add population density, classification, and census block columns to a dataset
+
+    Parameters
+    --------------------------------
+    fireDF : Dataframe
+        containing "X-Long" and "Y_Lat" columns
+    points : GeoDataFrame (optional)
+        incident points already made by boundaries.getPoints, to avoid building them again
+    """
+    if points is None:
+        points = boundaries.getPoints(fireDF)
 
-# Setup base directory
-base_dir = sf.get_base_dir()
-
-def addPopDen(fireDF):
     print("loading population grid:")
-    # Update file path using base_dir
-    popData_path = path.join(base_dir, "Shape", "PopulationDensityInESD2.shp")
-    popData = gpd.read_file(popData_path)
-    
-    # ESD2Pop needed this, PopDenInESD2 is already in 4326
+    # ESD2Pop needed a crs set, PopDenInESD2 is already in 4326
     # specify that source data is WGS 84 / Pseudo-Mercator -- Spherical Mercator, Google Maps, OpenStreetMap, Bing, ArcGIS, ESRI' - https://epsg.io/3857
-    # popData.set_crs(epsg=3857, inplace=True)
-    # and convert to 'World Geodetic System 1984' (used in GPS) - https://epsg.io/4326
-    # popData = popData.to_crs(4326)
+    # popData = boundaries.loadShape("ESD2Pop", crs=3857)
+    popData = boundaries.loadShape("PopulationDensityInESD2")
 
     # weird aliases... this is 'total population' / 'AreaofLAND(meters)'
     # population_name = "B01001_001"
     # area_name = "ALAND"
-    popData["Pop/Mile"] = popData.apply(lambda x: x["POP_SQMI"], axis=1)
-
-    print("loading Block Data:")
-
-    blockData_path = path.join(base_dir, "Shape", "BlockData.shp")
-    blockData = gpd.read_file(blockData_path)
-    blockData.set_crs(epsg=4326, inplace=True)
-
-    def getPopulationDensity(lon, lat):
-        plot = Point(lon, lat)
-        try:
-            mapInd = (popData.index[popData.contains(plot)])[0]
-            return popData.loc[mapInd, "Pop/Mile"]
-        except:
-            return None
-
-    from tqdm import tqdm
-
-    tqdm.pandas(
-        desc=f"finding Population Data:",
-        leave=False,
-    )
-    fireDF["People/Mile"] = fireDF.progress_apply(
-        lambda x: getPopulationDensity(x["X-Long"], x["Y_Lat"]),
-        axis=1,
+    print("finding Population Data:")
+    fireDF["People/Mile"] = boundaries.getContainingValue(points, popData, "POP_SQMI").astype(float).to_numpy()
+
+    pop = fireDF["People/Mile"]
+    fireDF["Population Classification"] = np.select(
+        [pop.isnull(), pop < 1000, pop < 2000],
+        ["Outside ESD2", "Rural", "Suburban"],
+        default="Urban",
     )
 
-    def popRatio(pop):
-        if pd.isnull(pop):
-            return "Outside ESD2"
-        if pop < 1000:
-            return "Rural"
-        if pop < 2000:
-            return "Suburban"
-        return "Urban"
-
-    fireDF["Population Classification"] = fireDF.apply(
-        lambda x: popRatio(x["People/Mile"]), axis=1
-    )
+    print("loading Block Data:")
+    blockData = boundaries.loadShape("BlockData", crs=4326)
 
-    def getBlockData(lon, lat):
-        plot = Point(lon, lat)
-        try:
-            # print(blockData)
-            mapInd = blockData.index[blockData.contains(plot)][0]
-            # GEOID20 = FIPS Alias
-            return blockData.loc[mapInd, "GEOID20"]
-            # return mapInd
-        except:
-            return None
-
-    fireDF["blockData"] = fireDF.apply(
-        lambda x: getBlockData(x["X-Long"], x["Y_Lat"]),
-        axis=1,
-    )
+    # GEOID20 = FIPS Alias
+    fireDF["blockData"] = boundaries.getContainingValue(points, blockData, "GEOID20").to_numpy()
 
     return fireDF
 
@@ -5,6 +5,7 @@ import pandas as pd
 from datetime import datetime as dt
 from dateutil.relativedelta import relativedelta as rd
 import utils
+import timer
 
 # from pandasgui import show
 
@@ -276,6 +277,7 @@ def revert_fire_format(df):
     df = df.drop(unused_new_columns_list, axis=1, errors="ignore")
     return df
 
+@timer.profiler.profiled("preprocess")
 def preprocess(df, start=None, end=None):
     if "Ph_PU_Time" in df.columns or "Ph PU Time" in df.columns:
         fileType = "ems"
@@ -354,21 +356,14 @@ def preprocess(df, start=None, end=None):
     # if the data was null, then we need to mark this.
     # Likely also the best time to check fire for the same thing: the call came from another department, and was 'delayed' before we were made aware.
     if fileType == "ems":
-        df["call_delayed"] = df.apply(
-            lambda row: bool(pd.isnull(row["Ph_PU_Time"])),
-            axis=1,
-        )
-        df["Ph_PU_Time"] = df.apply(
-            lambda row: row["Ph_PU_Date"]
-            if pd.isnull(row["Ph_PU_Time"])
-            else row["Ph_PU_Time"],
-            axis=1,
+        df["call_delayed"] = df["Ph_PU_Time"].isnull()
+        df["Ph_PU_Time"] = (
+            df["Ph_PU_Time"]
+            .where(~df["call_delayed"], df["Ph_PU_Date"])
+            .infer_objects()
         )
     else:
-        df["call_delayed"] = df.apply(
-            lambda row: bool(row["Calltaker Agency"] in ["APD", "TCSO", "PPD"]),
-            axis=1,
-        )
+        df["call_delayed"] = df["Calltaker Agency"].isin(["APD", "TCSO", "PPD"])
 
     print(" -- Matching Column Contents")
     # duplicate cell:  closed_time -> ["last real unit clear incident", "incident time call closed"]
@@ -462,26 +457,22 @@ def preprocess(df, start=None, end=None):
     # =================================================================
     print(" -- Ordering Rows")
 
-    def getFrontline(frontline_status, unit):
-        if "Safe" in unit:
-            return (
-                True  # Do not ignore units with 'Safe' regardless of frontline status
-            )
-        return frontline_status == "Frontline"
+    def getFrontline(frontline_status, units):
+        # a blank or numeric unit name can't be checked for 'Safe', so the whole column is treated as unknown
+        if pd.api.types.infer_dtype(units, skipna=False) != "string":
+            raise TypeError("Radio_Name holds values which are not text")
+        # Do not ignore units with 'Safe' regardless of frontline status
+        return units.str.contains("Safe", regex=False) | (frontline_status == "Frontline")
 
     try:
-        df["isFrontlineOrSafe"] = df.apply(
-            lambda row: getFrontline(row["Frontline_Status"], row["Radio_Name"]), axis=1
-        )
+        df["isFrontlineOrSafe"] = getFrontline(df["Frontline_Status"], df["Radio_Name"])
     except Exception as ex:
         df["isFrontlineOrSafe"] = False
         print(
             f"\n\t\t------------ERROR --------------\n\t\t{ex}\n\t\t---------end ---------------\n"
         )
 
-    df["Not Arrived"] = df.apply(
-        lambda row: pd.isnull(row["Unit Time Arrived At Scene"]), axis=1
-    )
+    df["Not Arrived"] = df["Unit Time Arrived At Scene"].isnull()
     df = utils.putColAt(df, ["isFrontlineOrSafe", "Not Arrived"], 1)
 
     df = df.sort_values(
@@ -0,0 +1,124 @@
+import hashlib
+import os
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+import pandas as pd
+
+import ServerFiles as sf
+
+logger = sf.setup_logging("rawFiles.log")
+# Setup base directory
+base_dir = sf.get_base_dir()
+
+# parsed copies of each raw excel file, named by the hash of the file's contents
+rawCacheDir = path.join(base_dir, "data", "rawCache")
+# oldest cached files are removed past this many
+maxCachedFiles = 50
+# prune the cache after each new file is cached.  worker processes turn this off, and the parent prunes once they finish,
+# so two workers never remove each other's files
+autoPrune = True
+
+# text columns which are read as text up front, rather than guessed cell by cell (ie: unit 201 as a number)
+rawDtypes = {
+    "Unit": str,
+    "Radio_Name": str,
+    "Unit_Name": str,
+    "Problem": str,
+    "Address": str,
+    "Address of Incident": str,
+    "City": str,
+    "Jurisdiction": str,
+    "Response_Area": str,
+    "Response Area": str,
+}
+
+# the most recently read files, kept in memory so reading a file twice in a row (ie: readRaw then addFiles) parses it once
+# {file hash: DataFrame}, oldest first.  anything older is read from the parquet cache instead
+loadedFiles = OrderedDict()
+maxLoadedFiles = 2
+
+
+def getFileHash(filePath):
+    """returns a hash of a file's contents, and of how it is parsed, so a changed file or dtype list is parsed again"""
+    h = hashlib.sha1(repr(sorted((k, v.__name__) for k, v in rawDtypes.items())).encode())
+    with open(filePath, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parseExcel(filePath):
+    """Parse an excel file with calamine when it is installed, which is many times faster than openpyxl"""
+    try:
+        return pd.read_excel(filePath, engine="calamine", dtype=rawDtypes)
+    except (ImportError, ValueError) as e:
+        logger.debug(f"calamine unavailable ({e}), reading {filePath} with the default engine")
+    return pd.read_excel(filePath, dtype=rawDtypes)
+
+
+def pruneCache():
+    """Remove the oldest cached files past maxCachedFiles"""
+    if not path.isdir(rawCacheDir):
+        return
+    cached = sorted(
+        (path.join(rawCacheDir, name) for name in os.listdir(rawCacheDir) if name.endswith(".parquet")),
+        key=path.getmtime,
+    )
+    for old in cached[:-maxCachedFiles]:
+        try:
+            os.remove(old)
+        except Exception as e:
+            logger.warning(f"Could not remove cached file {old}: {e}")
+
+
+def readExcel(filePath):
+    """
+    Read a raw CAD excel file, parsing each file only once
+
+    The parsed frame is kept as a Parquet copy in data/rawCache, and the last few in memory,
+    both keyed by the hash of the file, so reading the same file again (in this or a later run) skips parsing it.
+
+    Parameters
+    --------------------------------
+    filePath : str
+        path to the .xlsx file
+
+    Returns
+    --------------------------------
+    DataFrame
+        a fresh copy, which the caller is free to modify
+    """
+    fileHash = getFileHash(filePath)
+    if fileHash in loadedFiles:
+        loadedFiles.move_to_end(fileHash)
+        return loadedFiles[fileHash].copy()
+
+    cachePath = path.join(rawCacheDir, f"{fileHash}.parquet")
+    df = None
+    if path.exists(cachePath):
+        try:
+            df = pd.read_parquet(cachePath)
+            # parquet brings text nulls back as None, where excel gives NaN
+            for col in df.columns[df.dtypes == object]:
+                df[col] = df[col].where(df[col].notnull(), np.nan)
+        except Exception as e:
+            logger.warning(f"Could not read cached file {cachePath}: {e}")
+
+    if df is None:
+        print(f"Parsing {filePath}")
+        df = parseExcel(filePath)
+        try:
+            os.makedirs(rawCacheDir, exist_ok=True)
+            df.to_parquet(cachePath)
+            if autoPrune:
+                pruneCache()
+        except Exception as e:
+            # columns of mixed types can't be stored as parquet: those files are only kept in memory
+            logger.warning(f"Could not cache {filePath}: {e}")
+
+    loadedFiles[fileHash] = df
+    while len(loadedFiles) > maxLoadedFiles:
+        loadedFiles.popitem(last=False)
+    return df.copy()
@@ -15,6 +15,10 @@ from timer import Timer
 import ServerFiles as sf
 from os import path
 from tqdm import tqdm
+import hashlib
+import json
+import pickle
+from scipy.spatial import cKDTree
 
 logger = sf.setup_logging("roads.log")
 # Setup base directory
@@ -23,9 +27,19 @@ base_dir = sf.get_base_dir()
 # This really is acting more like a class than a set of functions, but I really need to look into proper class declaration for python 3 ...
 
 stationNode = ""
+stationLengths = {}
 roadMap = ""
+roadMapHash = ""
+nodeIndex = None
+nodeIndexHash = ""
+nodeIds = None
 bypass = False
 distBuf = 10000  # 10 for testing, so everything goes much faster.  Actual data should be 10000 (~6.2 miles)
+distCachePath = path.join(base_dir, "data", "roads", "stationDistances.pkl")
+roadArtifactPath = path.join(base_dir, "data", "roads", "roadMap.pkl")
+consolidateTolerance = 5
+snapWarnDist = 1500  # feet (~.3 miles) from the nearest node before an incident is flagged as off the road network
+metersToMiles = float(0.000621371)
 
 
 def toCrs(lat, lon):
@@ -64,8 +78,8 @@ def setStation(station):
 
     point = toCrs(coords[1], coords[0])
 
-    node = ox.nearest_nodes(roadMap, point.x, point.y)
-    nodeDist = ox.nearest_nodes(roadMap, point.x, point.y, return_dist=True)
+    nodes, nodeDist = getNearestNodes([point.x], [point.y])
+    node = nodes[0]
 
     # print("===== Station node:distance - \n", nodeDist)
     # print(point)
@@ -97,12 +111,11 @@ def distToStationFromGPS(lat, lon):
     # get the nearest network node to each point
     point = toCrs(lon, lat)
 
-    dest_node = ox.nearest_nodes(roadMap, point.x, point.y)
-
-    nodeDist = ox.nearest_nodes(roadMap, point.x, point.y, return_dist=True)
+    nodes, nodeDist = getNearestNodes([point.x], [point.y])
+    dest_node = nodes[0]
 
     # if the incident is more than .3 miles from nearest node, something is problematic
-    # if nodeDist[1] > 500:
+    # if nodeDist[0] > 500:
     #     return -1
 
     # print("===== Station node:distance - \n", nodeDist)
@@ -174,35 +187,127 @@ def distToStationFromNode(dest_node, bucket, date, fullProgress=None):
     if date < stationSet["DateIncluded"]:
         # print("DATE BEFORE ACTIVE")
         return np.inf
-    try:
-        # how long is our route in meters?
-        dist = nx.shortest_path_length(roadMap, stationNode, dest_node, weight="length")
-    except:
+
+    # how long is our route in meters?  Nodes missing from the station lookup cannot be reached
+    dist = stationLengths.get(dest_node)
+    if dist is None:
         if stationNode == "":
             print(
                 "You have likely just attempted to find the distance from a station, without first setting a station (setStation(lat,lon))"
             )
-        # else:
-        # print("error getting finding path between: ", station, " & ", dest_node)
-        ## usually the map is to small and a connection cannot be found
-        # traceback.print_stack()
         return None
 
-    distInMiles = dist * float(0.000621371)
+    distInMiles = dist * metersToMiles
     return distInMiles
 
 
+# ##############################################################################################################################################
+#     Station Distance Cache
+# ##############################################################################################################################################
+
+
+def graphHash(G):
+    """
+    returns a hash of the nodes and weighted edges of a road graph, used to tell if cached routing is still valid
+    """
+    h = hashlib.sha1()
+    h.update(repr(list(G.nodes)).encode())
+    h.update(repr(list(G.edges(data="length"))).encode())
+    return h.hexdigest()
+
+
+def getStationDistances():
+    """
+    returns the road distance (in meters) from every station to every reachable node on roadMap
+
+    A single source dijkstra is run once per station, rather than one shortest path per station per incident.
+    Results are saved to disk, and reused for as long as the road map and stations.json are unchanged.
+
+    Returns
+    --------------------------------
+    Dict
+        {station name: {node: meters}}
+    """
+    import getData as data
+
+    stationsHash = hashlib.sha1(
+        json.dumps(data.getStations(), sort_keys=True).encode()
+    ).hexdigest()
+    cacheKey = (roadMapHash, stationsHash)
+
+    if exists(distCachePath):
+        try:
+            with open(distCachePath, "rb") as cacheFile:
+                cache = pickle.load(cacheFile)
+            if cache["key"] == cacheKey:
+                print("Station distances loaded from cache")
+                return cache["distances"]
+            print("Station distance cache is out of date, rebuilding")
+        except Exception as e:
+            logger.warning(f"Could not read station distance cache: {e}")
+
+    distances = {}
+    for curStat in tqdm(stationDict, desc="Routing All Stations:"):
+        node = setStation(stationDict[curStat])
+        distances[curStat] = nx.single_source_dijkstra_path_length(
+            roadMap, node, weight="length"
+        )
+
+    try:
+        with open(distCachePath, "wb") as cacheFile:
+            pickle.dump(
+                {"key": cacheKey, "distances": distances},
+                cacheFile,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    except Exception as e:
+        logger.warning(f"Could not write station distance cache: {e}")
+
+    return distances
+
+
 # ##############################################################################################################################################
 #     GDF Addition Functions
 # ##############################################################################################################################################
 
 
-def getPoint(point, type):
-    if type not in ["ENG", "MED"]:
-        return None
-    if pd.isnull(point.x) | pd.isnull(point.y):
-        return None
-    return ox.nearest_nodes(roadMap, point.x, point.y)
+def getNodeIndex():
+    """
+    returns a KD-tree over the coordinates of every node on roadMap, along with the matching node ids.
+    The tree is only rebuilt when roadMap changes.
+    """
+    global nodeIndex
+    global nodeIndexHash
+    global nodeIds
+
+    if nodeIndex is None or nodeIndexHash != roadMapHash:
+        nodes = list(roadMap.nodes(data=True))
+        nodeIds = np.array([node for node, _ in nodes])
+        coords = np.array([[data["x"], data["y"]] for _, data in nodes])
+        nodeIndex = cKDTree(coords)
+        nodeIndexHash = roadMapHash
+    return nodeIndex, nodeIds
+
+
+def getNearestNodes(xs, ys):
+    """
+    returns the nearest roadMap node to each of the passed points, in a single query
+
+    Parameters
+    --------------------------------
+    xs : array like
+        x coordinates, in the same projection as roadMap (EPSG:2277)
+    ys : array like
+        y coordinates, in the same projection as roadMap (EPSG:2277)
+
+    Returns
+    --------------------------------
+    (np.ndarray, np.ndarray)
+        nearest node ids, and the distance (in feet) from each point to that node
+    """
+    tree, ids = getNodeIndex()
+    dist, ind = tree.query(np.column_stack([xs, ys]))
+    return ids[ind], dist
 
 
 def addNearestNodeToGDF(gdf):
@@ -217,54 +322,68 @@ def addNearestNodeToGDF(gdf):
     Returns
     --------------------------------
     GDF
-        copy of gdf, but with an extra row for nearest node on RoadMap
+        copy of gdf, but with extra rows for nearest node on RoadMap, and distance (in feet) to that node
     """
-    tqdm.pandas(desc="Finding nearest Nodes:")
-
-    # with tqdm(total=len(gdf.index), desc="Finding nearest Nodes:") as pbar:
-    gdf["nearest node"] = gdf.progress_apply(
-        lambda row: getPoint(row.geometry, row["Bucket Type"]), axis=1
+    print("Finding nearest Nodes:")
+    gdf["nearest node"] = None
+    gdf["nearest node distance"] = np.nan
+
+    xs = gdf.geometry.x.to_numpy()
+    ys = gdf.geometry.y.to_numpy()
+    needed = (
+        gdf["Bucket Type"].isin(["ENG", "MED"]).to_numpy()
+        & np.isfinite(xs)
+        & np.isfinite(ys)
     )
+    if needed.any():
+        nodes, dist = getNearestNodes(xs[needed], ys[needed])
+        gdf.loc[needed, "nearest node"] = pd.Series(nodes.tolist(), index=gdf.index[needed], dtype=object)
+        gdf.loc[needed, "nearest node distance"] = dist
+
+    offRoad = gdf.index[gdf["nearest node distance"] > snapWarnDist]
+    if len(offRoad) > 0:
+        logger.warning(
+            f"{len(offRoad)} incidents are more than {snapWarnDist} feet from the road network: {gdf.loc[offRoad, 'Master Incident Number'].unique().tolist()}"
+        )
 
     return gdf
 
 
 def getArrayDistToStation(df):
     """
-    returns the distance to a previously set statation for a a passed dataframe
-    requires a station be set.  May crash if no station is set.
+    returns the distance to every station for a a passed dataframe
 
     Parameters
     --------------------------------
     df : Dataframe
-        should contain latitude and longitudes for each location
+        should contain a nearest node, bucket type, and phone pickup time for each location
 
     Returns
     --------------------------------
     Dataframe
     """
-    with tqdm(
-        total=len(stationDict) * len(df.index), desc="Routing All Stations:"
-    ) as stationBar:
-        for curStat in stationDict:
-            stationBar.update(1)
-            # set station on road map
-            setStation(stationDict[curStat])
-            # calculate distances
-
-            tqdm.pandas(
-                desc=f"Calculating distance to {curStat}:",
-                leave=False,
-            )
-            df[f"Distance to {curStat} in miles"] = df.progress_apply(
-                lambda x: distToStationFromNode(
-                    x["nearest node"],
-                    x["Bucket Type"],
-                    x["Earliest Time Phone Pickup AFD or EMS"],
-                    stationBar,
-                ),
-                axis=1,
-            )
+    global stationLengths
+
+    distances = getStationDistances()
+
+    for curStat in tqdm(stationDict, desc="Calculating Station Distances:"):
+        # set station on road map
+        setStation(stationDict[curStat])
+        stationLengths = distances[curStat]
+
+        # look up distances, and mark unreachable nodes as None
+        dist = df["nearest node"].map(stationLengths) * metersToMiles
+        dist[df["nearest node"].isnull()] = None
+
+        # exclude stations without ambos from med calls, stations without ENGs from eng calls, and stations not yet open
+        excluded = (
+            ((df["Bucket Type"] == "MED") & (not stationSet["hasEMS"]))
+            | ((df["Bucket Type"] == "ENG") & (not stationSet["hasFire"]))
+            | (df["Earliest Time Phone Pickup AFD or EMS"] < stationSet["DateIncluded"])
+        )
+        dist[excluded & df["nearest node"].notnull()] = np.inf
+
+        df[f"Distance to {curStat} in miles"] = dist
 
     return df
 
@@ -335,8 +454,88 @@ def simplifyMap(G):
     return GCon
 
 
+def fileHash(filePath):
+    """
+    returns a sha1 of a files contents, read in chunks so large GraphML files are not held in memory
+    """
+    h = hashlib.sha1()
+    with open(filePath, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def buildRoadArtifact(sourcePath, tolerance=consolidateTolerance):
+    """
+    Loads a GraphML road map, projects and consolidates it, projects it to Texas Local (EPSG:2277),
+    and writes the finished graph to roadArtifactPath so later runs can skip all of that work.
+
+    Parameters
+    --------------------------------
+    sourcePath : str
+        path to the GraphML file to build from
+    tolerance : int
+        consolidate_intersections tolerance
+
+    Returns
+    --------------------------------
+    Dict
+        {"source": source file hash, "tolerance": tolerance, "graphHash": hash of the finished graph, "graph": finished graph}
+    """
+    sourceHash = fileHash(sourcePath)
+
+    G = ox.load_graphml(sourcePath)
+    print(" projecting map...")
+    GProj = ox.project_graph(G)
+
+    print(" Consolidating...")
+    GCon = ox.consolidate_intersections(
+        GProj, rebuild_graph=True, tolerance=tolerance, dead_ends=False
+    )
+
+    print("Projecting to Texas Local Map...")
+    GFIPS = ox.project_graph(GCon, to_crs="epsg:2277")
+
+    artifact = {
+        "source": sourceHash,
+        "tolerance": tolerance,
+        "graphHash": graphHash(GFIPS),
+        "graph": GFIPS,
+    }
+
+    print("  Saving Road Map Artifact ...")
+    try:
+        with open(roadArtifactPath, "wb") as artifactFile:
+            pickle.dump(artifact, artifactFile, protocol=pickle.HIGHEST_PROTOCOL)
+        print("  Save Complete!")
+    except Exception as e:
+        logger.warning(f"Could not write road map artifact: {e}")
+
+    return artifact
+
+
+def loadRoadArtifact(sourcePath, tolerance=consolidateTolerance):
+    """
+    returns the saved road map artifact, or None if it is missing or was built from a different source file or tolerance
+    """
+    if not exists(roadArtifactPath):
+        return None
+    try:
+        with open(roadArtifactPath, "rb") as artifactFile:
+            artifact = pickle.load(artifactFile)
+    except Exception as e:
+        logger.warning(f"Could not read road map artifact: {e}")
+        return None
+
+    if artifact["tolerance"] != tolerance or artifact["source"] != fileHash(sourcePath):
+        print("Road map artifact is out of date, rebuilding")
+        return None
+    return artifact
+
+
 def getRoads():
     global roadMap
+    global roadMapHash
 
     roads_graphml_path = path.join(base_dir, "data", "roads", "roadsProjected.graphml")
     if not exists(roads_graphml_path):
@@ -350,24 +549,24 @@ def getRoads():
             G = ox.load_graphml(roads_partial_path)
         # then prep for final data
         GCon = simplifyMap(G)
-    else:
-        print("Completed Map Exists, this will be quite quick")
-        G = ox.load_graphml(roads_graphml_path)
-        print(" projecting map...")
-        GProj = ox.project_graph(G)
-
-        print(" Consolidating...")
-        GCon = ox.consolidate_intersections(
-            GProj, rebuild_graph=True, tolerance=5, dead_ends=False
-        )
 
-    print("Projecting to Texas Local Map...")
-    GFIPS = ox.project_graph(GCon, to_crs="epsg:2277")
+        print("Projecting to Texas Local Map...")
+        GFIPS = ox.project_graph(GCon, to_crs="epsg:2277")
+        GFIPSHash = graphHash(GFIPS)
+    else:
+        artifact = loadRoadArtifact(roads_graphml_path)
+        if artifact is not None:
+            print("Completed Map Exists, this will be quite quick")
+        else:
+            artifact = buildRoadArtifact(roads_graphml_path)
+        GFIPS = artifact["graph"]
+        GFIPSHash = artifact["graphHash"]
 
     print("Map is ready for use!")
 
     # store and return the data
     roadMap = GFIPS
+    roadMapHash = GFIPSHash
     return GFIPS
 
 
@@ -409,7 +608,7 @@ def addRoadDistances(df):
     # show(gdf)
 
     # these dont really mean anything without the context of the graph, so drop them off... and then garbage collect gdf
-    df = pd.DataFrame(gdf.drop(columns=["geometry", "nearest node"]))
+    df = pd.DataFrame(gdf.drop(columns=["geometry", "nearest node", "nearest node distance"]))
     gdf = None
     # add Closest Station column
     df = addClosestStations(df)
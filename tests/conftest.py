@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the modules are flat files at the root of the repository
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
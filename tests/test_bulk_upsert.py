@@ -0,0 +1,114 @@
+import pandas as pd
+import pytest
+
+import Database as D
+
+truncateError = (
+    "String or binary data would be truncated in table 'ESD.dbo.FireUnits', column 'Unit'. Truncated value: 'BAD'"
+)
+
+
+class FakeCursor:
+    """Records what is sent to the stage table, and fails any executemany including a row with Unit 'BAD'"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.fast_executemany = False
+
+    def execute(self, stmt):
+        self.conn.statements.append(stmt.strip())
+
+    def executemany(self, stmt, rows):
+        self.conn.batches.append(list(rows))
+        if any("BAD" in row for row in rows):
+            raise Exception(truncateError)
+        self.conn.pending.extend(rows)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.batches = []
+        self.pending = []
+        self.merged = []
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.merged.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        self.closed = True
+
+
+class FakeEngine:
+    def __init__(self):
+        self.conn = FakeConnection()
+
+    def raw_connection(self):
+        return self.conn
+
+
+@pytest.fixture
+def db():
+    db = D.SQLDatabase.__new__(D.SQLDatabase)
+    db.engine = FakeEngine()
+    return db
+
+
+def units(names):
+    return pd.DataFrame(
+        {
+            "Incident_Number": [f"F{i}" for i in range(len(names))],
+            "Unit": names,
+            "Unit_Assigned": pd.Timestamp("2024-03-01 10:00:00"),
+        },
+        index=[10 * i for i in range(len(names))],
+    )
+
+
+def test_batches(db):
+    df = units(["E1", "E2", "M1", "M2", "Q1"])
+    failures = db.insert_dataframe(df, "FireUnits", ["Incident_Number", "Unit"], bulk=True, batch_size=2)
+
+    conn = db.engine.conn
+    assert failures.empty
+    assert [len(batch) for batch in conn.batches] == [2, 2, 1]
+    assert [row[1] for row in conn.merged] == ["E1", "E2", "M1", "M2", "Q1"]
+    assert sum(stmt.startswith("MERGE INTO FireUnits") for stmt in conn.statements) == 3
+
+
+def test_failed_batch_is_retried_row_by_row(db):
+    df = units(["E1", "BAD", "M1", "M2"])
+    failures = db.insert_dataframe(df, "FireUnits", ["Incident_Number", "Unit"], bulk=True, batch_size=3)
+
+    conn = db.engine.conn
+    # the failed batch of 3, then each of its rows alone, then the last batch
+    assert [len(batch) for batch in conn.batches] == [3, 1, 1, 1, 1]
+    assert [row[1] for row in conn.merged] == ["E1", "M1", "M2"]
+    assert failures["index"].tolist() == [10]
+    assert failures.loc[0, "error"] == db.check_simple_errors(Exception(truncateError))
+
+
+def test_duplicate_keys_keep_last(db):
+    df = units(["E1", "E2"])
+    df = pd.concat([df, df.iloc[[0]].assign(Unit_Assigned=pd.Timestamp("2024-03-01 11:00:00"))])
+    db.insert_dataframe(df, "FireUnits", ["Incident_Number", "Unit"], bulk=True)
+
+    merged = db.engine.conn.merged
+    assert len(merged) == 2
+    assert merged[-1][2] == pd.Timestamp("2024-03-01 11:00:00").to_pydatetime()
+
+
+def test_stage_table_dropped(db):
+    db.insert_dataframe(units(["BAD"]), "FireUnits", ["Incident_Number", "Unit"], bulk=True)
+
+    conn = db.engine.conn
+    assert conn.statements[-1].startswith("IF OBJECT_ID('tempdb..#UpsertStage') IS NOT NULL DROP TABLE")
+    assert conn.closed
@@ -0,0 +1,36 @@
+from os import path
+
+import pandas as pd
+import pytest
+
+import preprocess as pp
+
+dataDir = path.join(path.dirname(path.abspath(__file__)), "data")
+
+# golden files: {case}_input.csv, and {case}_expected.csv written by the row by row (apply) version of preprocess
+cases = [
+    "preprocess_ems",
+    "preprocess_fire",
+    # blank unit names: isFrontlineOrSafe falls back to False for every row, changing the sort order
+    "preprocess_fire_blank_units",
+]
+
+textColumns = ["Unit", "Radio_Name", "Unit_Type", "Frontline_Status", "Agency", "Calltaker Agency"]
+numberColumns = ["Incident", "Master_Incident_Number"]
+
+
+def readInput(name):
+    """read an input file as it comes from a raw excel file: text as text, and times as datetimes"""
+    df = pd.read_csv(path.join(dataDir, name), dtype={col: str for col in textColumns})
+    for col in df.columns:
+        if col not in textColumns + numberColumns:
+            df[col] = pd.to_datetime(df[col])
+    return df
+
+
+@pytest.mark.parametrize("case", cases)
+def test_preprocess_matches_golden_file(case):
+    df = pp.preprocess(readInput(f"{case}_input.csv"))
+    with open(path.join(dataDir, f"{case}_expected.csv"), newline="") as file:
+        expected = file.read()
+    assert df.to_csv(index=False) == expected
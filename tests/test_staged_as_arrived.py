@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import analyzefire as af
+
+unitCols = {
+    "Unit Respond to Arrival": ["Unit Time Enroute", False],
+    "Unit Dispatch to Onscene": ["Unit Time Assigned", False],
+    "Unit OnScene to Clear Call": ["Unit Time Call Cleared", True],
+}
+
+
+def legacyRecalc(df, rows, flagCol, recalcCols, staged):
+    """the cell by cell loop recalcFromStaged replaced"""
+
+    def getSingleTimeDiff(df, row, t1, t2, reverse):
+        if not reverse:
+            res = df.loc[row, t2] - df.loc[row, t1]
+        else:
+            res = df.loc[row, t1] - df.loc[row, t2]
+        # Convert to seconds
+        return res / np.timedelta64(1, "s")
+
+    for i in rows.tolist():
+        df.loc[i, flagCol] = 1
+        for col in recalcCols:
+            df.loc[i, col] = getSingleTimeDiff(df, i, recalcCols[col][0], staged, recalcCols[col][1])
+
+
+def syntheticUnits(seed, n):
+    rng = np.random.default_rng(seed)
+    base = pd.Timestamp("2024-03-01") + pd.to_timedelta(rng.integers(0, 10**6, n), unit="s")
+    df = pd.DataFrame({"Unit Time Assigned": base})
+    for col, offset in [
+        ("Unit Time Enroute", 60),
+        ("Unit Time Staged", 300),
+        ("Unit Time Arrived At Scene", 600),
+        ("Unit Time Call Cleared", 3000),
+    ]:
+        df[col] = base + pd.to_timedelta(rng.integers(0, offset * 2, n), unit="s")
+        df.loc[rng.random(n) < 0.1, col] = pd.NaT
+    for col in unitCols:
+        df[col] = rng.normal(300, 100, n)
+    df["UNIT_Staged_As_Arrived"] = 0
+    return df
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_recalcFromStaged_matches_loop(seed):
+    df = syntheticUnits(seed, 500)
+    rows = df.index[(df["Unit Time Staged"] < df["Unit Time Arrived At Scene"]) & (df["Unit Time Staged"] > df["Unit Time Enroute"])]
+
+    expected = df.copy()
+    legacyRecalc(expected, rows, "UNIT_Staged_As_Arrived", unitCols, "Unit Time Staged")
+    af.recalcFromStaged(df, rows, "UNIT_Staged_As_Arrived", unitCols, "Unit Time Staged")
+
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_recalcFromStaged_no_rows():
+    df = syntheticUnits(0, 20)
+    expected = df.copy()
+    af.recalcFromStaged(df, df.index[:0], "UNIT_Staged_As_Arrived", unitCols, "Unit Time Staged")
+    pd.testing.assert_frame_equal(df, expected)
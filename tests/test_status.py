@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import analyzefire as af
+
+ourNames = ["ESD02"]
+
+
+def legacyStatus(fileDF):
+    """the row by row Status loop addStatus replaced"""
+    conditions = [
+        (fileDF["Master Incident Number"] != fileDF.shift(1)["Master Incident Number"])
+        & (fileDF["Unit Time Arrived At Scene"].isnull()),
+        (fileDF["Master Incident Number"] == fileDF.shift(1)["Master Incident Number"]),
+    ]
+    fileDF["Status"] = np.select(conditions, ["C", "0"], default="1")
+    for i in fileDF.index[fileDF["Status"] == "0"].tolist():
+        fileDF.loc[i, "Status"] = "X" if fileDF.loc[i - 1, "Status"] in ["X", "C"] else "0"
+    return fileDF
+
+
+def legacyTransportStatus(fileDF, ourNames):
+    """the row by row transportCheck loop fixTransportStatus replaced"""
+    transportCheck = fileDF[
+        (pd.isnull(fileDF["Unit Time Arrived At Scene"])) & (fileDF["Transport_Count"] > 0)
+    ].index.tolist()
+    for i in transportCheck:
+        ours = (fileDF.loc[i, "Incident Call Count"] == 1) and fileDF.loc[i, "Department"] in ourNames
+        fileDF.loc[i, "Status"] = "1" if ours else "0"
+        fileDF.loc[i, "Response_Status"] = "ONSC"
+        fileDF.loc[i, "FirstArrivedEsri"] = "1" if ours else "-"
+    return fileDF
+
+
+def randomIncidents(seed):
+    """a sorted frame of incidents of 1 or more units, some canceled, some with missing incident numbers"""
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(0, 200))
+    incidents = np.sort(rng.integers(0, max(1, n // 2), n)).astype(object)
+    if seed % 3 == 0:
+        incidents[rng.random(n) < 0.05] = np.nan
+    arrived = pd.Series(
+        pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 9, n), unit="min")
+    )
+    arrived[rng.random(n) < rng.random()] = pd.NaT
+    return pd.DataFrame(
+        {
+            "Master Incident Number": incidents,
+            "Unit Time Arrived At Scene": arrived,
+            "Transport_Count": rng.integers(0, 2, n),
+            "Incident Call Count": rng.integers(1, 3, n),
+            "Department": rng.choice(["ESD02", "AFD", None], n),
+            "Response_Status": "ENRT",
+            "FirstArrivedEsri": "Yes",
+        }
+    )
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_status_matches_loop(seed):
+    df = randomIncidents(seed)
+
+    expected = legacyTransportStatus(legacyStatus(df.copy()), ourNames)
+    result = af.fixTransportStatus(af.addStatus(df.copy()), ourNames)
+
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_canceled_incident_marks_every_unit():
+    df = pd.DataFrame(
+        {
+            "Master Incident Number": [1, 1, 1, 2, 2, 3],
+            "Unit Time Arrived At Scene": pd.to_datetime([None, None, None, "2024-01-01", None, None]),
+        }
+    )
+    assert af.addStatus(df)["Status"].tolist() == ["C", "X", "X", "1", "0", "C"]
@@ -1,6 +1,24 @@
 # timer.py
 
 import time
+import csv
+import json
+import logging
+import tracemalloc
+from datetime import datetime
+from functools import wraps
+from os import path
+
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
 
 
 class TimerError(Exception):
@@ -33,3 +51,192 @@ class Timer:
     def end(self):
         """Stop the timer, and report the elapsed time"""
         self.stop()
+
+
+# ===============================================================================================================
+#  Stage profiling
+#  Records wall time, rows in/out, peak memory growth and DataFrame/Series.apply calls for each named stage,
+#  and keeps a RunReport (json and csv) up to date next to the RunLog after every top level stage.
+# ===============================================================================================================
+# every stage records how far it raised the process's peak resident memory, which is cheap to read.
+# tracemalloc gives the python heap's peak for each stage instead, but makes every allocation many times slower
+# (and so every stage's timing), so it is only used when debugging
+trackMemory = False
+
+
+def peakRSS():
+    """The process's peak resident memory so far in bytes, or None where it can't be read"""
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        if hasattr(info, "peak_wset"):  # windows
+            return info.peak_wset
+    if resource is not None:
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+def rowCount(df):
+    try:
+        return len(df)
+    except TypeError:
+        return None
+
+
+class Stage:
+    """A single running stage of a StageProfiler.  End it with .end(df), or move on with .next(name, df)"""
+
+    def __init__(self, profiler, name, df=None):
+        self.profiler = profiler
+        self.name = name
+        self.rowsIn = rowCount(df)
+        self.peak = 0
+        self._start_mem = 0
+        self._start_rss = peakRSS()
+        self._start_applies = profiler.applyCalls
+        self._start_time = time.perf_counter()
+        if trackMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.profiler.notePeak()
+            self._start_mem = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.profiler.running.append(self)
+
+    def end(self, df=None):
+        """Stop the stage, record it, and return the record"""
+        elapsed_time = time.perf_counter() - self._start_time
+        peakDelta = None
+        if trackMemory and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            peakDelta = max(self.peak - self._start_mem, 0)
+        elif self._start_rss is not None:
+            peakDelta = peakRSS() - self._start_rss
+        # inner stages left open (by an exception) end along with this one
+        del self.profiler.running[self.profiler.running.index(self) :]
+        # the outer stages must still see the peak reached in here
+        for outer in self.profiler.running:
+            outer.peak = max(outer.peak, self.peak)
+
+        record = {
+            "stage": self.name,
+            "depth": len(self.profiler.running),
+            "seconds": round(elapsed_time, 4),
+            "rows_in": self.rowsIn,
+            "rows_out": rowCount(df),
+            "peak_memory_mb": None if peakDelta is None else round(peakDelta / 2**20, 2),
+            "apply_calls": self.profiler.applyCalls - self._start_applies,
+        }
+        self.profiler.stages.append(record)
+        if not self.profiler.running:
+            if trackMemory and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self.profiler.uninstall()
+            self.profiler.writeReport()
+        return record
+
+    def next(self, name, df=None):
+        """End this stage with df as its output, and start the next one with df as its input"""
+        self.end(df)
+        return self.profiler.start(name, df)
+
+
+class StageProfiler:
+    """Collects a record of every stage run in this process, and writes them as the RunReport"""
+
+    def __init__(self):
+        self.stages = []
+        self.running = []
+        self.applyCalls = 0
+        self.runtime = datetime.now().strftime("%Y.%m.%d %H.%M")
+        # the original apply methods, while they are replaced by counting ones
+        self._originals = None
+
+    def install(self):
+        """Count every DataFrame.apply and Series.apply call, until uninstall() puts the originals back"""
+        if self._originals is not None:
+            return
+        self._originals = (pd.DataFrame.apply, pd.Series.apply)
+        profiler = self
+
+        def counted(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                profiler.applyCalls += 1
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        pd.DataFrame.apply = counted(pd.DataFrame.apply)
+        pd.Series.apply = counted(pd.Series.apply)
+
+    def uninstall(self):
+        if self._originals is None:
+            return
+        pd.DataFrame.apply, pd.Series.apply = self._originals
+        self._originals = None
+
+    def notePeak(self):
+        # keep the peak reached so far by running stages before a new stage resets it
+        if self.running and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            for stage in self.running:
+                stage.peak = max(stage.peak, peak)
+
+    def start(self, name, df=None):
+        """Start a stage, with df as its input.  apply calls are only counted while a stage is running"""
+        self.install()
+        return Stage(self, name, df)
+
+    def profiled(self, name):
+        """
+        Decorator recording a whole function as a stage.
+        The first DataFrame argument is the input, and the returned DataFrame (if any) is the output.
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                df = next((a for a in args if isinstance(a, pd.DataFrame)), None)
+                stage = self.start(name, df)
+                try:
+                    result = func(*args, **kwargs)
+                except Exception:
+                    stage.end()
+                    raise
+                stage.end(result if isinstance(result, pd.DataFrame) else None)
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def reportPath(self):
+        """The RunReport path, without extension: beside the RunLog if there is one, otherwise the working directory"""
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.FileHandler):
+                logDir, logName = path.split(handler.baseFilename)
+                if logName.startswith("RunLog-"):
+                    return path.join(logDir, path.splitext(logName.replace("RunLog-", "RunReport-", 1))[0])
+                fallbackDir = logDir
+                break
+        else:
+            fallbackDir = "."
+        return path.join(fallbackDir, f"RunReport-{self.runtime}")
+
+    def writeReport(self):
+        if not self.stages:
+            return
+        reportPath = self.reportPath()
+        try:
+            with open(f"{reportPath}.json", "w") as file:
+                json.dump(self.stages, file, indent=2)
+            with open(f"{reportPath}.csv", "w", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=list(self.stages[0].keys()))
+                writer.writeheader()
+                writer.writerows(self.stages)
+        except Exception as e:
+            logging.warning(f"Could not write run report {reportPath}: {e}")
+
+
+profiler = StageProfiler()
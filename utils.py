@@ -87,6 +87,59 @@ def verifyTime(x):
         return None
 
 
+def toDatetime(series):
+    """
+    Returns a passed series coerced to datetime64 in one pass, and a mask of the values which could not be parsed
+
+    :param series: Panda Series, holding datetimes, strings, or nulls
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series, pd.Series(False, index=series.index)
+    # blanks are nulls, not failures
+    series = series.where(series != "", None)
+    converted = pd.to_datetime(series, errors="coerce", format="mixed")
+    failed = converted.isnull() & series.notnull()
+    return converted, failed
+
+
+def addTimeDiffs(df, cols):
+    """
+    Returns a passed dataframe with a column of seconds added for every interval, and a diagnostics frame of the values which could not be parsed
+
+    Each source column is converted once, no matter how many intervals use it, and every interval is a single datetime64 subtraction.
+
+    :param df: Panda Dataframe, dataframe to add rows too
+    :param cols: {str: [str, str]}, the name of each column to be created: [the column of the start datetime, the column of the end datetime]
+    """
+    times = {}
+    errors = []
+    for timeStart, timeEnd in cols.values():
+        for col in [timeStart, timeEnd]:
+            if col in times:
+                continue
+            times[col], failed = toDatetime(df[col])
+            if failed.any():
+                errors.append(
+                    pd.DataFrame(
+                        {
+                            "Master Incident Number": df.loc[failed, "Master Incident Number"],
+                            "Column": col,
+                            "Value": df.loc[failed, col],
+                        }
+                    )
+                )
+
+    for nt, (timeStart, timeEnd) in cols.items():
+        df[nt] = (times[timeEnd] - times[timeStart]).dt.total_seconds()
+
+    diagnostics = (
+        pd.concat(errors)
+        if errors
+        else pd.DataFrame(columns=["Master Incident Number", "Column", "Value"])
+    )
+    return df, diagnostics
+
+
 def addTimeDiff(df, nt, timeStart, timeEnd):
     """
     Returns a copy of a passed dataframe with a new row added
@@ -96,40 +149,7 @@ def addTimeDiff(df, nt, timeStart, timeEnd):
     :param timeStart: str, the name of the row in df which houses the start datetime
     :param timeEnd: str, the name of the row in df which houses the end datetime
     """
-    global last
-    last = []
-    # ensure valid dateTime, or properly noted error
-    # df[timeEnd] = df[timeEnd].apply(verifyTime)
-    # df[timeStart] = df[timeStart].apply(verifyTime)
-
-    def tryGetTime(inc, end, start):
-        if pd.isnull(start) or pd.isnull(end):
-            return None
-        try:
-            return pd.to_timedelta(
-                verifyTime(end) - verifyTime(start), unit="seconds", errors="raise"
-            ) / np.timedelta64(1, "s")
-        except Exception as err:
-
-            print(f"-------  {inc}  ------\n{err}")
-            return None
-
-    # df[nt] = (df[timeEnd] - df[timeStart]).astype("timedelta64[s]")
-    df[nt] = df.apply(
-        lambda row: tryGetTime(
-            row["Master Incident Number"], row[timeEnd], row[timeStart]
-        ),
-        axis=1,
-    )
-
-    # print(df[nt])
-
-    # print(type(df.loc[1, nt]))
-    # print(formatSeconds(float(df.loc[1, nt])))
-
-    # convert from seconds into H:M:S
-    # df[nt] = df[nt].apply(formatSeconds)
-
+    df, diagnostics = addTimeDiffs(df, {nt: [timeStart, timeEnd]})
     return df
 
 
@@ -170,26 +190,32 @@ def addUnitType(orig):
     return orig
 
 
+unitBuckets = {
+    "BT": "ENG",
+    "ENG": "ENG",
+    "QNT": "ENG",
+    "RS": "ENG",
+    "TK": "ENG",
+    "LAD": "ENG",
+    "M": "MED",
+    "MED": "MED",
+    # MED COM!  remove
+    # "MEDC": "MED",
+}
+
+
 def getUnitBucket(type):
-    buckets = {
-        "BT": "ENG",
-        "ENG": "ENG",
-        "QNT": "ENG",
-        "RS": "ENG",
-        "TK": "ENG",
-        "LAD": "ENG",
-        "M": "MED",
-        "MED": "MED",
-        # MED COM!  remove
-        # "MEDC": "MED",
-    }
-    if type not in buckets:
+    if type not in unitBuckets:
         return type
-    return buckets[type]
+    return unitBuckets[type]
 
 
 def addBucketType(orig):
-    orig["Bucket Type"] = orig.apply(lambda x: getUnitBucket(x["Unit Type"]), axis=1)
+    # unit types without a bucket are kept as they are
+    unitType = orig["Unit Type"]
+    orig["Bucket Type"] = unitType.where(
+        ~unitType.isin(list(unitBuckets)), unitType.map(unitBuckets)
+    )
     return orig
 
 